@@ -5,6 +5,7 @@ from flask import Blueprint, jsonify, make_response, request, session
 from werkzeug.security import check_password_hash
 
 from crud import crud
+from gpt.openai import completion_cache
 from settings import ADMIN, HPSW
 
 api_admin = Blueprint("api_admin", __name__, url_prefix="/api/admin")
@@ -104,7 +105,7 @@ def user_del():
     return jsonify(), 204
 
 
-# GET prompt_id, limit + page
+# GET prompt_id, limit + after_id | before_id + count (legacy: page)
 @api_admin.route("/user/<int:user_id>/content")
 @login_req
 def content(user_id):
@@ -112,7 +113,7 @@ def content(user_id):
     return jsonify(res)
 
 
-# GET limit + page
+# GET limit + after_id | before_id + count (legacy: page)
 @api_admin.route("/user/<int:user_id>/prompt")
 @login_req
 def prompt(user_id):
@@ -156,3 +157,17 @@ def prompt_mods():
 
     res = crud.get_prompt_mod_all()
     return jsonify(res)
+
+
+# POST None (clear cache)
+@api_admin.route("/gpt_cache", methods=["GET", "POST"])
+@login_req
+def gpt_cache():
+    if completion_cache is None:
+        return jsonify(message="cache off. settings: GPT_CACHE=true"), 404
+
+    if request.method == "POST":
+        completion_cache.clear()
+        return jsonify(message="success"), 201
+
+    return jsonify(completion_cache.stats())
@@ -1,14 +1,27 @@
 # 201 add/edit success; 204 No content; 400 bad request; 401 unauthorized;
 # 405 method not allowed; # 506 internal configuration error;
-from flask import Blueprint, jsonify, make_response, request
+# 202 job queued (settings.JOB_QUEUE): poll /api/user/job/<job_id>
+from math import ceil
+
+from flask import (
+    Blueprint,
+    Response,
+    jsonify,
+    make_response,
+    request,
+    stream_with_context,
+)
 from flask_login import current_user, login_required, login_user, logout_user
 from validators import email as valid_email
 from werkzeug.security import check_password_hash, generate_password_hash
 
-from crud import crud
+from crud import crud, split_topics
 from dalle_gen import dalle_gen
-from gpt import gpt_gen
-from settings import VALID_EMAIL, VALID_PSW, SECRET
+from gpt.batch import gpt_batch
+from gpt.resume import gpt_resume
+from gpt.run import gpt_run
+from gpt.stream import gpt_stream, sse
+from settings import JOB_POLL, JOB_QUEUE, VALID_EMAIL, VALID_PSW, SECRET
 from userlogin import UserLogin
 from utils import random_chars, send_email, valid_psw
 
@@ -154,7 +167,7 @@ def pf_list():
     return jsonify(res)
 
 
-# GET limit + page
+# GET limit + after_id | before_id + count (legacy: page)
 @api_user.route("/prompt")
 @login_required
 def prompt():
@@ -207,6 +220,24 @@ def prompt_field_del(prompt_id, pfield_id):
     return jsonify(), 204
 
 
+# GET n + order(normal|reverse|random) / POST topics(a;b;..) - append to queue
+@api_user.route("/prompt/<int:prompt_id>/topics", methods=["GET", "POST"])
+@login_required
+def prompt_topics(prompt_id):
+    if request.method == "POST":
+        topics = split_topics(request.form.get("topics"))
+        res = crud.append_topics(current_user.get_id(), prompt_id, topics)
+        return jsonify(message="success", added=len(topics), count=res), 201
+
+    res = crud.peek_topics(
+        current_user.get_id(),
+        prompt_id,
+        request.args.get("n", 10, type=int),
+        request.args.get("order", "normal"),
+    )
+    return jsonify(res)
+
+
 # POST day + hour + minute + timezone
 @api_user.route("/prompt/<int:prompt_id>/timetable", methods=["GET", "POST"])
 @login_required
@@ -235,7 +266,7 @@ def timetable_del(prompt_id, timetable_id):
     return jsonify(), 204
 
 
-# GET prompt_id, limit + page
+# GET prompt_id, limit + after_id | before_id + count (legacy: page)
 @api_user.route("/content")
 @login_required
 def content():
@@ -266,7 +297,7 @@ def content_edit(content_id):
     return jsonify(res)
 
 
-# POST None #[ ] gpt_gen
+# POST None #[ ] gpt_run
 @api_user.route("/content/get_topic/<int:prompt_id>", methods=["POST"])
 @login_required
 def content_get_topic(prompt_id):
@@ -274,15 +305,60 @@ def content_get_topic(prompt_id):
     if len(topic) < 3:
         return jsonify([])
 
-    res = gpt_gen(current_user.get_id(), prompt_id, topic=topic)
+    if JOB_QUEUE:
+        return queue_job("topic", {"prompt_id": prompt_id, "topic": topic})
+
+    res = gpt_run(current_user.get_id(), prompt_id, topic=topic)
     return jsonify(res)
 
 
-# POST None #[ ] gpt_gen
+# POST None; ?stream=true - server-sent events: content, text.., done | error
 @api_user.route("/content/add_by/<int:prompt_id>", methods=["POST"])
 @login_required
 def content_add(prompt_id):
-    res = gpt_gen(current_user.get_id(), prompt_id)
+    if request.args.get("stream") == "true":
+        events = gpt_stream(current_user.get_id(), prompt_id)
+        return Response(
+            stream_with_context(sse(events)),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    if JOB_QUEUE:
+        return queue_job("gen", {"prompt_id": prompt_id})
+
+    res = gpt_run(current_user.get_id(), prompt_id)
+    return jsonify(res), 201
+
+
+# POST n - number of topics (default: params.batch)
+@api_user.route("/content/batch_by/<int:prompt_id>", methods=["POST"])
+@login_required
+def content_batch(prompt_id):
+    n = request.form.get("n", 0, type=int)
+    if JOB_QUEUE:
+        return queue_job("batch", {"prompt_id": prompt_id, "n": n})
+
+    res = gpt_batch(current_user.get_id(), prompt_id, n)
+    return jsonify(res), 201
+
+
+# GET longread run: state, topic, toc, chapters (state done | failed, error)
+@api_user.route("/gen_run/<int:run_id>")
+@login_required
+def gen_run(run_id):
+    res = crud.get_gen_run(current_user.get_id(), run_id)
+    return jsonify(res)
+
+
+# POST None - regenerate missing and failed chapters, reassemble content
+@api_user.route("/gen_run/<int:run_id>/resume", methods=["POST"])
+@login_required
+def gen_run_resume(run_id):
+    if JOB_QUEUE:
+        return queue_job("resume", {"run_id": run_id})
+
+    res = gpt_resume(current_user.get_id(), run_id)
     return jsonify(res), 201
 
 
@@ -360,5 +436,26 @@ def iprompt_del(iprompt_id):
 )
 @login_required
 def images_add(content_id, iprompt_id):
+    if JOB_QUEUE:
+        return queue_job("dalle", {"content_id": content_id, "iprompt_id": iprompt_id})
+
     res = dalle_gen(current_user.get_id(), content_id, iprompt_id)
     return jsonify(res), 201
+
+
+def queue_job(kind: str, args: dict):
+    "add job for gpt_worker.py. -> 202 + job"
+    res = crud.add_job(current_user.get_id(), kind, args)
+    return jsonify(message="queued", job=res), 202
+
+
+# GET - job state now (no long-poll: web worker is not held). not finished:
+# Retry-After header, client polls again
+@api_user.route("/job/<int:job_id>")
+@login_required
+def job(job_id):
+    res = crud.get_job(current_user.get_id(), job_id)
+    response = jsonify(res)
+    if res["state"] in ("queued", "running"):
+        response.headers["Retry-After"] = str(ceil(JOB_POLL))
+    return response
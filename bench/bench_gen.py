@@ -0,0 +1,106 @@
+"""end-to-end generation benchmark against bench.fake_openai. no money spent.\n
+drives real gpt_run / dalle_gen with db (use a separate DB_PATH_SQLITE!)\n
+python -m bench.bench_gen --kind longread --articles 20 --workers 4 --latency 0.5\n
+reports: articles/min, p50/p99 latency, db writes per article, fake server stats
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from bench.fake_openai import from_args, parse_args, run_in_thread
+
+KINDS = ("shortread", "longread", "dalle")
+
+
+def setup(crud, kind: str, articles: int) -> tuple[int, int]:
+    "bench user + prompt with topic_list. -> (user_id, prompt_id | iprompt_id)"
+    user_id = crud.register(f"bench_{os.getpid()}@local", "bench").as_dict()["id"]
+    crud.edit_user(user_id, {"active": 1, "tokens": 10**9})
+    if kind == "dalle":
+        iprompt = crud.add_iprompt(user_id)
+        crud.edit_iprompt(user_id, iprompt["id"], {"main": "", "number": 1})
+        return user_id, iprompt["id"]
+
+    prompt = crud.add_prompt(user_id)
+    params = '{"longread": %s, "debug": false}' % str(kind == "longread").lower()
+    topics = "; ".join(f"bench topic {i}" for i in range(articles))
+    crud.edit_prompt(user_id, prompt["id"], {"topic_list": topics, "params": params})
+    return user_id, prompt["id"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--kind", choices=KINDS, default="shortread")
+    parser.add_argument("--articles", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parse_args(parser)
+
+    fake = from_args(args)
+    os.environ["OPENAI_URL"] = run_in_thread(fake)
+    os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+    os.environ["OPENAI_RPM"] = str(10**6)  # measure the app, not the limiter
+    os.environ["OPENAI_TPM"] = str(10**9)
+    os.environ["IMG_RPM"] = str(10**6)
+    os.environ["RATELIMIT_PATH"] = os.path.join(tempfile.mkdtemp(), "ratelimit.db")
+    os.environ["GPT_CACHE"] = "false"
+    assert "settings" not in sys.modules, "env must be set before settings import"
+
+    from sqlalchemy import event
+
+    import dalle_gen
+    from app import app
+    from crud import crud
+    from gpt.run import gpt_run
+
+    dalle_gen.IMG_PATH = tempfile.mkdtemp()
+    writes = Counter()
+
+    def run(user_id, target_id) -> float:
+        with app.app_context():
+            start = perf_counter()
+            if args.kind == "dalle":
+                content = crud.add_content(user_id, text="bench text")
+                dalle_gen.dalle_gen(user_id, content["id"], target_id)
+            else:
+                gpt_run(user_id, target_id)
+            return perf_counter() - start
+
+    with app.app_context():
+        crud.db.create_all()
+        user_id, target_id = setup(crud, args.kind, args.articles)
+
+        @event.listens_for(crud.db.engine, "before_cursor_execute")
+        def count_writes(conn, cursor, statement, *_):
+            if statement.lstrip()[:6].upper() in ("INSERT", "UPDATE", "DELETE"):
+                writes["db"] += 1
+
+    start = perf_counter()
+    with ThreadPoolExecutor(args.workers) as pool:
+        futures = [pool.submit(run, user_id, target_id) for _ in range(args.articles)]
+    latency, failed = [], 0
+    for future in futures:
+        try:
+            latency.append(future.result())
+        except Exception as e:
+            failed += 1
+            print(f"FAIL: {e!r}")
+    elapsed = perf_counter() - start
+
+    done = len(latency) or 1
+    q = statistics.quantiles(latency, n=100) if len(latency) > 1 else latency * 99
+    print(f"kind {args.kind}, workers {args.workers}, fake latency {args.latency}")
+    print(f"articles:         {len(latency)} ok, {failed} failed")
+    print(f"articles/min:     {len(latency) / elapsed * 60:.1f}")
+    print(f"latency p50/p99:  {q[49]:.2f} / {q[98]:.2f} sec")
+    print(f"db writes/article: {writes['db'] / done:.1f}")
+    print(f"fake server:      {dict(fake.stats)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""parse_mark benchmark: legacy (re.search on slices) vs single pass vs streamed.\n
+python -m bench.bench_parse_mark --sizes 0.5 1 2 4 8 --legacy-max 1\n
+linear: sec/MB stays flat while size grows
+"""
+
+import argparse
+import random
+import re
+from time import perf_counter
+
+from gpt.creator import MarkParser, parse_mark
+
+
+def legacy_parse_mark(text: str) -> dict[str, str]:
+    "parse_mark before single pass parser: quadratic"
+    pattern = r"##[\w:-]+"
+    result = {}
+    for match in re.finditer(pattern, text):
+        key = match.group(0)
+        content_start = match.end()
+        next_match = re.search(pattern, text[content_start:])
+        content_end = (
+            len(text) if next_match is None else next_match.start() + content_start
+        )
+        content = text[content_start:content_end]
+        result[key.strip("#:-")] = content.strip(" \n'\";:.,")
+    return result
+
+
+def streamed(text: str, chunk: int = 20) -> dict[str, str]:
+    "MarkParser fed by chunk chars, like stream_openai_completion()"
+    parser = MarkParser()
+    for i in range(0, len(text), chunk):
+        parser.feed(text[i : i + chunk])
+    return parser.close()
+
+
+def make_text(size: int, field: int, seed: int = 0) -> str:
+    "~size chars: ##field_N + ~field chars of words"
+    rnd = random.Random(seed)
+    words = "lorem ipsum dolor sit amet, consectetur adipiscing elit.".split()
+    parts, n, i = [], 0, 0
+    while n < size:
+        body = " ".join(rnd.choice(words) for _ in range(field // 6))
+        part = f"##field_{i}: {body}\n"
+        parts.append(part)
+        n += len(part)
+        i += 1
+    return "".join(parts)
+
+
+def timeit(func, text: str) -> tuple[float, dict]:
+    start = perf_counter()
+    res = func(text)
+    return perf_counter() - start, res
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=float, nargs="+", default=[0.5, 1, 2, 4, 8])
+    parser.add_argument("--field", type=int, default=200, help="chars per field")
+    parser.add_argument("--legacy-max", type=float, default=1, help="MB")
+    args = parser.parse_args()
+
+    print(f"{'MB':>5} {'fields':>7} {'name':>8} {'sec':>8} {'sec/MB':>8}")
+    for mb in args.sizes:
+        text = make_text(int(mb * 1024**2), args.field)
+        funcs = {"single": parse_mark, "stream": streamed}
+        if mb <= args.legacy_max:
+            funcs["legacy"] = legacy_parse_mark
+        expected = None
+        for name, func in funcs.items():
+            sec, res = timeit(func, text)
+            expected = expected or res
+            assert res == expected, f"{name}: result differs"
+            print(f"{mb:>5} {len(res):>7} {name:>8} {sec:>8.3f} {sec / mb:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
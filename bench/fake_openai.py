@@ -0,0 +1,179 @@
+"""local stand-in for openai api. no money spent.\n
+endpoints: /v1/completions (+ stream), /v1/images/generations, /imgs/<name>\n
+python -m bench.fake_openai --port 8010 --latency 0.5 --error-rate 0.05 --length-rate 0.1
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+from collections import Counter
+from threading import Thread
+
+from aiohttp import web
+
+LOREM = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua"
+).split()
+
+
+class FakeOpenAI:
+    """latency: median sec of lognormal distribution (sigma - spread)\n
+    error_rate: part of requests answered with 429 + Retry-After\n
+    length_rate: part of completions with finish_reason='length'\n
+    words: words in completion text"""
+
+    def __init__(
+        self,
+        latency: float = 0.2,
+        sigma: float = 0.5,
+        error_rate: float = 0.0,
+        length_rate: float = 0.0,
+        retry_after: float = 1,
+        words: int = 300,
+        seed: int | None = None,
+    ) -> None:
+        self.latency = latency
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.length_rate = length_rate
+        self.retry_after = retry_after
+        self.words = words
+        self.random = random.Random(seed)
+        self.stats = Counter()
+
+    def delay(self) -> float:
+        if not self.latency:
+            return 0
+        return self.random.lognormvariate(math.log(self.latency), self.sigma)
+
+    def text(self) -> str:
+        "numbered TOC + text + ##fields: fits every creator"
+        words = " ".join(self.random.choice(LOREM) for _ in range(self.words))
+        return (
+            "1. Introduction\n2. Main part\n3. Conclusion\n\n"
+            f"{words}\n\n##title Fake title\n##keywords fake, bench"
+        )
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/completions", self.completions)
+        app.router.add_post("/v1/images/generations", self.images)
+        app.router.add_get("/imgs/{name}", self.image)
+        return app
+
+    async def _error(self) -> web.Response | None:
+        await asyncio.sleep(self.delay())
+        if self.random.random() < self.error_rate:
+            self.stats["429"] += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "requests"}},
+                status=429,
+                headers={"Retry-After": str(self.retry_after)},
+            )
+
+    async def completions(self, request: web.Request) -> web.StreamResponse:
+        payload = await request.json()
+        self.stats["completions"] += 1
+        error = await self._error()
+        if error:
+            return error
+
+        finish_reason = "stop"
+        if self.random.random() < self.length_rate:
+            self.stats["length"] += 1
+            finish_reason = "length"
+        text = self.text()
+        prompt_tokens = len(payload["prompt"].split())
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(text.split()),
+            "total_tokens": prompt_tokens + len(text.split()),
+        }
+        if not payload.get("stream"):
+            return web.json_response(
+                {
+                    "model": payload["model"],
+                    "choices": [{"text": text, "finish_reason": finish_reason}],
+                    "usage": usage,
+                }
+            )
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        chunks = text.split(" ")
+        for i, chunk in enumerate(chunks):
+            last = i == len(chunks) - 1
+            choice = {
+                "text": chunk if last else chunk + " ",
+                "finish_reason": finish_reason if last else None,
+            }
+            data = json.dumps({"model": payload["model"], "choices": [choice]})
+            await response.write(f"data: {data}\n\n".encode())
+            await asyncio.sleep(0)
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def images(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        self.stats["images"] += 1
+        error = await self._error()
+        if error:
+            return error
+
+        url = f"{request.url.origin()}/imgs/"
+        return web.json_response(
+            {"data": [{"url": f"{url}{i}.jpg"} for i in range(payload.get("n", 1))]}
+        )
+
+    async def image(self, request: web.Request) -> web.Response:
+        return web.Response(
+            body=b"\xff\xd8fake jpeg\xff\xd9", content_type="image/jpeg"
+        )
+
+
+def run_in_thread(fake: FakeOpenAI, host="127.0.0.1", port=0) -> str:
+    "start server in daemon thread. -> base url for settings.OPENAI_URL"
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(fake.app(), access_log=None)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, host, port)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    Thread(target=loop.run_forever, daemon=True).start()
+    return f"http://{host}:{port}/v1"
+
+
+def parse_args(parser: argparse.ArgumentParser | None = None) -> argparse.Namespace:
+    parser = parser or argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.2, help="median, sec")
+    parser.add_argument("--sigma", type=float, default=0.5, help="lognormal spread")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="part of 429")
+    parser.add_argument("--length-rate", type=float, default=0.0, help="part of length")
+    parser.add_argument("--retry-after", type=float, default=1, help="429 header, sec")
+    parser.add_argument("--words", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args()
+
+
+def from_args(args: argparse.Namespace) -> FakeOpenAI:
+    return FakeOpenAI(
+        latency=args.latency,
+        sigma=args.sigma,
+        error_rate=args.error_rate,
+        length_rate=args.length_rate,
+        retry_after=args.retry_after,
+        words=args.words,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8010)
+    args = parse_args(parser)
+    print(f"OPENAI_URL=http://{args.host}:{args.port}/v1")
+    web.run_app(from_args(args).app(), host=args.host, port=args.port)
@@ -0,0 +1,11 @@
+from loguru import logger
+
+from app import app
+from crud import crud
+
+if __name__ == "__main__":
+    logger = logger.bind(name="db")
+
+    with app.app_context():
+        res = crud.rebuild_counters()
+        logger.warning(f"COUNTERS REBUILD >> {res}")
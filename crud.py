@@ -1,13 +1,20 @@
 import inspect
+import json
+import random
+from collections import Counter
+from datetime import datetime, timedelta, timezone
 from math import ceil
 from time import time
-from typing import Dict, List, Union
+from typing import Callable, Dict, List, Union
 
 from flask_sqlalchemy import SQLAlchemy
 from loguru import logger
-from sqlalchemy import func
+from sqlalchemy import delete, func, insert, literal, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 import models as m
+from settings import TOPIC_CLAIM
 
 logger = logger.bind(name="db")
 
@@ -16,6 +23,27 @@ class DatabaseException(Exception):
     pass
 
 
+NEVER = 2**53  # next_run_at of timetable without valid weekday: never due
+
+
+def next_run_at(day_utc, hour_utc: int, minute: int, after: int) -> int:
+    """first UTC timestamp > after on weekday of day_utc digits (1-7), hour:minute.
+    no weekday -> NEVER"""
+    days = {int(i) for i in str(day_utc) if i in "1234567"}
+    start = datetime.fromtimestamp(after, timezone.utc)
+    start = start.replace(hour=int(hour_utc), minute=int(minute), second=0)
+    for i in range(8):
+        run = start + timedelta(days=i)
+        if run.isoweekday() in days and run.timestamp() > after:
+            return int(run.timestamp())
+    return NEVER
+
+
+def split_topics(text: str) -> List[str]:
+    "'a; b; c' -> ['a', 'b', 'c']"
+    return [i.strip() for i in (text or "").split(";") if i.strip()]
+
+
 class CRUD:
     def __init__(self, db: SQLAlchemy):
         self.__db = db
@@ -33,6 +61,57 @@ class CRUD:
         msg = f"error db.py in {inspect.stack()[1][3]}: {str(e)}"
         raise DatabaseException(msg) from e
 
+    def _page(self, query, model, filter: dict, count: Callable = None) -> Dict:
+        """one page of query, newest first. keyset: rows after (older than) or
+        before (newer than) cursor id, no scan of skipped rows.\n
+        filter: limit(100, <0: all), after_id | before_id, count(false): + total.
+        legacy page(1): offset pagination, always counted.
+        -> Dict.keys: 'list' (models), 'afterId', 'beforeId' (cursors of next
+        and previous page or None), ?'count' + 'totalPage', ?'currentPage'.
+        count: -> total, instead of query.count()"""
+        lim = int(filter.get("limit", 100))
+        after_id = int(filter.get("after_id") or 0)
+        before_id = int(filter.get("before_id") or 0)
+        page = None if after_id or before_id else filter.get("page")
+        res = {}
+        if before_id:
+            rows = query.filter(model.id > before_id).order_by(model.id)
+        elif after_id:
+            rows = query.filter(model.id < after_id).order_by(model.id.desc())
+        else:
+            rows = query.order_by(model.id.desc())
+        if page is not None:
+            res["currentPage"] = int(page)
+            rows = rows.offset((res["currentPage"] - 1) * lim)
+        rows = rows.limit(lim + 1 if lim > 0 else lim).all()  # all: limit < 0
+        more = 0 < lim < len(rows)
+        rows = rows[:lim] if more else rows
+        if before_id:
+            rows.reverse()
+        older = more or (before_id and rows)
+        newer = (more and before_id) or (
+            rows and (after_id or page not in (None, 1, "1"))
+        )
+        res["list"] = rows
+        res["afterId"] = rows[-1].id if older else None
+        res["beforeId"] = rows[0].id if newer else None
+
+        if page is not None or str(filter.get("count")).lower() in ("true", "1"):
+            res["count"] = count() if count else query.count()
+            res["totalPage"] = ceil(res["count"] / lim) if res["count"] > lim > 0 else 1
+        return res
+
+    def _children(self, model, parent: str, ids: list) -> Dict[int, List[Dict]]:
+        "rows of model by parent id column in one IN query -> {id: [dict, ...]}"
+        res = {i: [] for i in ids}
+        if not res:
+            return res
+        column = getattr(model, parent)
+        rows = model.query.filter(column.in_(res)).order_by(model.id)
+        for i in rows:
+            res[getattr(i, parent)].append(i.as_dict())
+        return res
+
     # User
     def register(self, email, psw) -> Union[m.User, None]:
         try:
@@ -42,6 +121,10 @@ class CRUD:
 
             res = m.User(email=email, psw=psw)
             self.__db.session.add(res)
+            self.__db.session.flush()
+            self.__db.session.add(
+                m.TokenLedger(user_id=res.id, tokens=res.tokens, note="trial")
+            )
             self.__db.session.commit()
             return res
 
@@ -86,7 +169,10 @@ class CRUD:
                 if k in ("active", "tokens", "exp_date"):
                     v = int(v)
                 if k == "tokens":
-                    v += res.tokens
+                    self.__db.session.add(
+                        m.TokenLedger(user_id=user_id, tokens=v, note="admin")
+                    )
+                    v = m.User.tokens + v  # atomic: SET tokens = tokens + v
                 if k == "exp_date" and v < 365 * 30:
                     v = (86400 * v) + int(max(res.exp_date, time()))
                 setattr(res, k, v)
@@ -96,6 +182,72 @@ class CRUD:
         except Exception as e:
             self._exc(e, rb=True)
 
+    def add_tokens(self, user_id, entries: List[tuple]) -> None:
+        # used_by gpt
+        """entries: [(tokens, note), ...]; tokens: + credit, - usage.
+        append entries to token_ledger and change balance in one atomic UPDATE"""
+        try:
+            self.__db.session.execute(
+                m.TokenLedger.__table__.insert(),
+                [
+                    {"user_id": user_id, "tokens": t, "note": n, "date": int(time())}
+                    for t, n in entries
+                ],
+            )
+            self.__db.session.execute(
+                update(m.User)
+                .where(m.User.id == user_id)
+                .values(tokens=m.User.tokens + sum(t for t, _ in entries))
+            )
+            self.__db.session.commit()
+
+        except Exception as e:
+            self._exc(e, rb=True)
+
+    def reconcile_tokens(self) -> Dict:
+        """rebuild user balances from token_ledger.
+        users without 'trial' / 'opening' entry (registered before ledger) get
+        'opening' entry: balance - entries already in ledger (charged before
+        the first reconcile)
+        -> {'opened': int, 'fixed': [{'user_id', 'tokens', 'ledger'}, ...]}"""
+        ledger = (
+            select(func.coalesce(func.sum(m.TokenLedger.tokens), 0))
+            .where(m.TokenLedger.user_id == m.User.id)
+            .scalar_subquery()
+        )
+        has_opening = (
+            select(m.TokenLedger.id)
+            .where(
+                m.TokenLedger.user_id == m.User.id,
+                m.TokenLedger.note.in_(("trial", "opening")),
+            )
+            .exists()
+        )
+        try:
+            opened = self.__db.session.execute(
+                insert(m.TokenLedger).from_select(
+                    ["user_id", "tokens", "note", "date"],
+                    select(
+                        m.User.id,
+                        m.User.tokens - ledger,
+                        literal("opening"),
+                        literal(int(time())),
+                    ).where(~has_opening),
+                )
+            ).rowcount
+            fixed = self.__db.session.execute(
+                select(m.User.id, m.User.tokens, ledger).where(m.User.tokens != ledger)
+            ).all()
+            self.__db.session.execute(
+                update(m.User).where(m.User.tokens != ledger).values(tokens=ledger)
+            )
+            self.__db.session.commit()
+            fixed = [{"user_id": i, "tokens": t, "ledger": n} for i, t, n in fixed]
+            return {"opened": opened, "fixed": fixed}
+
+        except Exception as e:
+            self._exc(e, rb=True)
+
     def edit_user_psw(self, email, hpsw) -> Dict:
         try:
             res = m.User.query.filter_by(email=email).first()
@@ -122,72 +274,200 @@ class CRUD:
             self._exc(e, rb=True)
 
     def statistic(self, user_id):
-        "-> 'prompt_count', 'content_count: true, false, total'"
+        "-> 'prompt_count', 'content_count: {post: count}, total'"
+        t = m.RowCount
         try:
-            p = m.Prompt.query.filter_by(user_id=user_id).count()
-            c = (
-                m.Content.query.with_entities(
-                    m.Content.post, func.count(m.Content.post)
+            c = self.__db.session.execute(
+                select(t.post, func.sum(t.value))
+                .where(t.user_id == user_id, t.kind == "content")
+                .group_by(t.post)
+            ).all()
+            c = {post: n for post, n in c if n}
+            c["total"] = sum(c.values())
+            return {"prompt_count": self._prompt_count(user_id), "content_count": c}
+
+        except Exception as e:
+            self._exc(e, rb=True)
+
+    # RowCount
+    def _count_rows(self, user_id, kind, n=1, prompt_id=0, post="") -> None:
+        """row_count += n in current transaction. no commit.
+        one upsert: concurrent first rows of a key do not fail the transaction"""
+        t = m.RowCount.__table__
+        key = {
+            "user_id": user_id,
+            "kind": kind,
+            "prompt_id": prompt_id or 0,
+            "post": "" if post is None else str(post),
+        }
+        dialect = self.__db.session.get_bind().dialect.name
+        upsert = pg_insert if dialect == "postgresql" else sqlite_insert
+        stmt = upsert(t).values(**key, value=n)
+        self.__db.session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=list(key), set_={"value": t.c.value + n}
+            )
+        )
+
+    def _count_contents(self, rows: list, n=1) -> None:
+        "row_count += n for each content row. no commit"
+        keys = Counter((i.user_id, i.prompt_id, i.post) for i in rows)
+        for (user_id, prompt_id, post), k in keys.items():
+            self._count_rows(user_id, "content", n * k, prompt_id, post)
+
+    def _content_count(self, user_id, prompt_id=0) -> int:
+        t = m.RowCount
+        query = select(func.coalesce(func.sum(t.value), 0)).where(
+            t.user_id == user_id, t.kind == "content"
+        )
+        if prompt_id:
+            query = query.where(t.prompt_id == prompt_id)
+        return self.__db.session.execute(query).scalar()
+
+    def _prompt_count(self, user_id) -> int:
+        t = m.RowCount
+        return self.__db.session.execute(
+            select(func.coalesce(func.sum(t.value), 0)).where(
+                t.user_id == user_id, t.kind == "prompt"
+            )
+        ).scalar()
+
+    def rebuild_counters(self) -> Dict:
+        """rebuild row_count from content and prompt tables.
+        -> {'rows': int, 'fixed': [{'user_id', 'kind', 'prompt_id', 'post',
+        'value', 'counted'}, ...]}"""
+        t = m.RowCount.__table__
+        names = ("user_id", "kind", "prompt_id", "post")
+        try:
+            old = {
+                tuple(i[:4]): i[4]
+                for i in self.__db.session.execute(
+                    select(*[t.c[k] for k in names], t.c.value)
                 )
-                .group_by(m.Content.post)
-                .all()
+            }
+            counted = {}
+            contents = self.__db.session.execute(
+                select(
+                    m.Content.user_id, m.Content.prompt_id, m.Content.post, func.count()
+                )
+                .where(m.Content.user_id.is_not(None))
+                .group_by(m.Content.user_id, m.Content.prompt_id, m.Content.post)
             )
-            c = dict(c)
-            c["total"] = sum(c.values())
-            return {"prompt_count": p, "content_count": c}
+            for user_id, prompt_id, post, n in contents:
+                key = (
+                    user_id,
+                    "content",
+                    prompt_id or 0,
+                    "" if post is None else str(post),
+                )
+                counted[key] = counted.get(key, 0) + n
+            prompts = self.__db.session.execute(
+                select(m.Prompt.user_id, func.count())
+                .where(m.Prompt.user_id.is_not(None))
+                .group_by(m.Prompt.user_id)
+            )
+            for user_id, n in prompts:
+                counted[(user_id, "prompt", 0, "")] = n
+
+            self.__db.session.execute(delete(t))
+            if counted:
+                self.__db.session.execute(
+                    insert(t),
+                    [dict(zip(names, k), value=v) for k, v in counted.items()],
+                )
+            self.__db.session.commit()
+            fixed = [
+                dict(zip(names, k), value=old.get(k, 0), counted=counted.get(k, 0))
+                for k in old.keys() | counted.keys()
+                if old.get(k, 0) != counted.get(k, 0)
+            ]
+            return {"rows": len(counted), "fixed": fixed}
 
         except Exception as e:
             self._exc(e, rb=True)
 
     # Prompt
     def get_prompt_all(self, user_id, filter) -> Dict:
-        "-> Dict.keys: 'list', 'totalPage', 'currentPage'"
-        lim = int(filter.get("limit", 100))
-        current_page = int(filter.get("page", 1))
-        offset = (current_page - 1) * lim
+        """filter dict: {'limit': 100, 'after_id' | 'before_id', 'count': false}
+        -> Dict.keys: 'list', 'afterId', 'beforeId' (see _page)"""
         try:
-            res = (
-                m.Prompt.query.filter_by(user_id=user_id)
-                .order_by(m.Prompt.id.desc())
-                .limit(lim)
-                .offset(offset)
-                .all()
-            )  # all: limit < 0, offset <= 0
-            count = m.Prompt.query.filter_by(user_id=user_id).count()
-            total_page = ceil(count / lim) if count / lim > 1 else 1
-            list_ = [i.as_dict() for i in res]
-            return {"list": list_, "totalPage": total_page, "currentPage": current_page}
+            res = self._page(
+                m.Prompt.query.filter_by(user_id=user_id),
+                m.Prompt,
+                filter,
+                lambda: self._prompt_count(user_id),
+            )
+            res["list"] = self._prompt_dicts(res["list"])
+            return res
 
         except Exception as e:
             self._exc(e)
 
     def get_prompt(self, user_id, prompt_id) -> Dict:
-        # used_by gpt
+        "prompt with topic_list text of its topic queue (editor)"
         try:
             res = m.Prompt.query.filter_by(user_id=user_id, id=prompt_id).first()
             if not res:
                 raise ValueError("record not found in db")
 
-            return res.as_dict()
+            return self._prompt_dicts([res], topics=True)[0]
+
+        except Exception as e:
+            self._exc(e)
+
+    def get_prompt_context(self, user_id, prompt_id) -> Dict:
+        # used_by gpt
+        """user, prompt, prompt field names and p_mod version in one query.
+        -> {"user": {}, "prompt": {}, "pfields": [name, ...], "mods_version": int}"""
+        try:
+            version = select(m.PModVersion.version).limit(1).scalar_subquery()
+            rows = self.__db.session.execute(
+                select(m.User, m.Prompt, m.PField.name, version)
+                .join(m.Prompt, m.Prompt.user_id == m.User.id)
+                .outerjoin(m.PField, m.PField.prompt_id == m.Prompt.id)
+                .where(m.User.id == user_id, m.Prompt.id == prompt_id)
+                .order_by(m.PField.id)
+            ).all()
+            if not rows:
+                raise ValueError("record not found in db")
+
+            user, prompt, _, mods_version = rows[0]
+            return {
+                "user": user.as_dict(),
+                "prompt": prompt.as_dict(),
+                "pfields": [i[2] for i in rows if i[2] is not None],
+                "mods_version": mods_version or 0,
+            }
 
         except Exception as e:
             self._exc(e)
 
     def edit_prompt(self, user_id, prompt_id, attrs: dict) -> Dict:
         # used_by gpt
-        "sets prompt setting value by its name"
+        """sets prompt setting value by its name.
+        topic_list 'a; b; ...' edits topic_queue (see _edit_topics),
+        topics not queued again -> 'topics_skipped': [topic, ...]"""
         try:
             res = m.Prompt.query.filter_by(user_id=user_id, id=prompt_id).first()
             if not res:
                 raise ValueError("record not found in db")
 
+            attrs = dict(attrs.items())
+            topics = attrs.pop("topic_list", None)
             for k, v in attrs.items():
                 if k in getattr(res, "_protected"):
                     raise AttributeError("protected attribute")
 
                 setattr(res, k, v)
+            skipped = None
+            if topics is not None:
+                res.topic_list = None
+                skipped = self._edit_topics(prompt_id, split_topics(topics))
             self.__db.session.commit()
-            return res.as_dict()
+            prompt = self._prompt_dicts([res])[0]
+            if skipped is not None:
+                prompt["topics_skipped"] = skipped
+            return prompt
 
         except Exception as e:
             self._exc(e, rb=True)
@@ -196,6 +476,7 @@ class CRUD:
         try:
             res = m.Prompt(user_id=user_id)
             self.__db.session.add(res)
+            self._count_rows(user_id, "prompt")
             self.__db.session.commit()
             return res.as_dict()
 
@@ -209,6 +490,222 @@ class CRUD:
                 raise ValueError("record not found in db")
 
             self.__db.session.delete(res)
+            self._count_rows(user_id, "prompt", -1)
+            self.__db.session.commit()
+
+        except Exception as e:
+            self._exc(e, rb=True)
+
+    # TopicQueue
+    def _topics_text(self, prompt_id) -> str:
+        "'topic; topic; ...' from topic_queue"
+        q = m.TopicQueue.__table__
+        rows = self.__db.session.execute(
+            select(q.c.topic).where(q.c.prompt_id == prompt_id).order_by(q.c.pos)
+        )
+        return "; ".join(rows.scalars())
+
+    def _topic_counts(self, prompt_ids: list) -> Dict:
+        "{prompt_id: topics in queue} in one query"
+        q = m.TopicQueue.__table__
+        rows = self.__db.session.execute(
+            select(q.c.prompt_id, func.count())
+            .where(q.c.prompt_id.in_(prompt_ids))
+            .group_by(q.c.prompt_id)
+        )
+        return dict(rows.all())
+
+    def _prompt_dicts(self, prompts: list, topics=False) -> List[Dict]:
+        """as_dict() with topic_count (not migrated: from topic_list text column).
+        topics: topic_list text of queue too, one prompt only"""
+        counts = self._topic_counts([i.id for i in prompts if not i.topic_list])
+        res = []
+        for i in prompts:
+            prompt = i.as_dict()
+            if i.topic_list:
+                prompt["topic_count"] = len(split_topics(i.topic_list))
+            else:
+                prompt["topic_count"] = counts.get(i.id, 0)
+                prompt["topic_list"] = self._topics_text(i.id) if topics else None
+            res.append(prompt)
+        return res
+
+    def _insert_topics(self, prompt_id, topics: List[str], front=False) -> None:
+        "bulk insert after the last (front: before the first) pos. no commit"
+        if not topics:
+            return
+        q = m.TopicQueue.__table__
+        edge = func.min(q.c.pos) if front else func.max(q.c.pos)
+        edge = self.__db.session.execute(
+            select(edge).where(q.c.prompt_id == prompt_id)
+        ).scalar()
+        if front:
+            start = (1 if edge is None else edge) - len(topics)
+        else:
+            start = (edge or 0) + 1
+        self.__db.session.execute(
+            insert(q),
+            [
+                {"prompt_id": prompt_id, "pos": start + i, "topic": topic}
+                for i, topic in enumerate(topics)
+            ],
+        )
+
+    def _edit_topics(self, prompt_id, topics: List[str]) -> List[str]:
+        """queue as topics: delete missing topics, append new ones. no commit.
+        topics with content of prompt are taken: stale topic_list does not put
+        them back (append_topics does). -> skipped taken topics"""
+        q = m.TopicQueue.__table__
+        rows = self.__db.session.execute(
+            select(q.c.id, q.c.topic).where(q.c.prompt_id == prompt_id)
+        ).all()
+        left = Counter(topics)
+        gone = []
+        for row_id, topic in rows:
+            if left[topic]:
+                left[topic] -= 1
+            else:
+                gone.append(row_id)
+        if gone:
+            self.__db.session.execute(delete(q).where(q.c.id.in_(gone)))
+        taken = self.__db.session.execute(
+            select(m.Content.title).where(
+                m.Content.prompt_id == prompt_id,
+                m.Content.title.in_([t for t, n in left.items() if n]),
+            )
+        ).scalars()
+        skipped = []
+        for topic in dict.fromkeys(taken):
+            skipped += [topic] * left[topic]
+            left[topic] = 0
+        new = []
+        for topic in topics:
+            if left[topic]:
+                left[topic] -= 1
+                new.append(topic)
+        self._insert_topics(prompt_id, new)
+        return skipped
+
+    def _migrate_topic_list(self, prompt: m.Prompt) -> None:
+        "old 'a; b; c' topic_list text -> topic_queue. no commit"
+        if prompt and prompt.topic_list:
+            self._insert_topics(prompt.id, split_topics(prompt.topic_list))
+            prompt.topic_list = None
+
+    def _own_prompt(self, user_id, prompt_id) -> m.Prompt:
+        res = m.Prompt.query.filter_by(user_id=user_id, id=prompt_id).first()
+        if not res:
+            raise ValueError("record not found in db")
+        return res
+
+    def append_topics(self, user_id, prompt_id, topics: List[str]) -> int:
+        "add topics to the end of queue. -> topics in queue"
+        try:
+            self._migrate_topic_list(self._own_prompt(user_id, prompt_id))
+            self._insert_topics(prompt_id, topics)
+            self.__db.session.commit()
+            return m.TopicQueue.query.filter_by(prompt_id=prompt_id).count()
+
+        except Exception as e:
+            self._exc(e, rb=True)
+
+    def _free_topics(self, prompt_id):
+        "where: topics of prompt not claimed (or claim expired)"
+        q = m.TopicQueue.__table__
+        return (q.c.prompt_id == prompt_id) & or_(
+            q.c.claimed.is_(None), q.c.claimed < int(time()) - TOPIC_CLAIM
+        )
+
+    def peek_topics(self, user_id, prompt_id, n=10, order="normal") -> Dict:
+        "-> {'topics': [next n free topics (random: as normal)], 'count': int}"
+        try:
+            prompt = self._own_prompt(user_id, prompt_id)
+            if prompt.topic_list:
+                self._migrate_topic_list(prompt)
+                self.__db.session.commit()
+            q = m.TopicQueue
+            free = q.query.filter(self._free_topics(prompt_id))
+            res = free.order_by(q.pos.desc() if order == "reverse" else q.pos).limit(n)
+            return {"topics": [i.topic for i in res], "count": free.count()}
+
+        except Exception as e:
+            self._exc(e, rb=True)
+
+    def _take_next_topics(self, prompt_id, n: int, order: str, claim: bool):
+        """one DELETE (claim: UPDATE claimed) ... RETURNING by (prompt_id, pos)
+        index. -> [{'topic', 'pos'} (claim: + 'id'), ...]. no commit"""
+        q = m.TopicQueue.__table__
+        where = self._free_topics(prompt_id)
+        ids = select(q.c.id).where(where).limit(n)
+        if order == "random":  # one topic, uniform: random offset in queue
+            count = self.__db.session.execute(
+                select(func.count()).select_from(q).where(where)
+            ).scalar()
+            if not count:
+                return []
+            ids = ids.order_by(q.c.pos).offset(random.randrange(count)).limit(1)
+        else:
+            ids = ids.order_by(q.c.pos.desc() if order == "reverse" else q.c.pos)
+        if claim:  # where again: row claimed by concurrent pop is skipped
+            stmt = update(q).where(q.c.id.in_(ids), where).values(claimed=int(time()))
+            stmt = stmt.returning(q.c.id, q.c.topic, q.c.pos)
+        else:
+            stmt = delete(q).where(q.c.id.in_(ids)).returning(q.c.topic, q.c.pos)
+        rows = self.__db.session.execute(stmt).all()
+        rows.sort(key=lambda i: i.pos, reverse=order == "reverse")
+        return [i._asdict() for i in rows]
+
+    def pop_topics(self, prompt_id, n=1, order="normal", claim=False) -> List[Dict]:
+        # used_by gpt
+        """atomically delete next n topics by order: normal | reverse | random.
+        -> [{'topic', 'pos'}, ...] (pos: to put topic back with push_topics).
+        claim: topics stay in queue as claimed until add_content_batch uses them
+        or release_topics; claim of dead worker expires in TOPIC_CLAIM sec.
+        -> [{'id', 'topic', 'pos'}, ...]"""
+        try:
+            self._migrate_topic_list(self.__db.session.get(m.Prompt, prompt_id))
+            res, misses = [], 0
+            while len(res) < n and misses < 3:
+                rows = self._take_next_topics(prompt_id, n - len(res), order, claim)
+                if not rows:  # empty or taken by concurrent pop (postgres)
+                    free = self._free_topics(prompt_id)
+                    if not m.TopicQueue.query.filter(free).first():
+                        break
+                    misses += 1
+                res += rows
+            self.__db.session.commit()
+            return res
+
+        except Exception as e:
+            self._exc(e, rb=True)
+
+    def pop_topic(self, prompt_id, order="normal") -> Dict | None:
+        # used_by gpt
+        "-> {'topic', 'pos'} | None"
+        res = self.pop_topics(prompt_id, 1, order)
+        return res[0] if res else None
+
+    def release_topics(self, ids: List[int]) -> None:
+        # used_by gpt
+        "claimed topics (pop_topics claim=True) are free again at their places"
+        try:
+            q = m.TopicQueue.__table__
+            self.__db.session.execute(
+                update(q).where(q.c.id.in_(ids)).values(claimed=None)
+            )
+            self.__db.session.commit()
+
+        except Exception as e:
+            self._exc(e, rb=True)
+
+    def push_topics(self, prompt_id, topics: List[Dict]) -> None:
+        # used_by gpt
+        "put popped topics [{'topic', 'pos'}] back to their places"
+        try:
+            self.__db.session.add_all(
+                m.TopicQueue(prompt_id=prompt_id, topic=i["topic"], pos=i["pos"])
+                for i in topics
+            )
             self.__db.session.commit()
 
         except Exception as e:
@@ -225,6 +722,14 @@ class CRUD:
         except Exception as e:
             self._exc(e)
 
+    def get_prompt_field_many(self, prompt_ids: list) -> Dict[int, List[Dict]]:
+        "prompt fields of page of prompts, one query -> {prompt_id: [pfield]}"
+        try:
+            return self._children(m.PField, "prompt_id", prompt_ids)
+
+        except Exception as e:
+            self._exc(e)
+
     def add_prompt_field(self, prompt_id, name, value) -> Dict:
         "adds a prompt field with name from pf_list table"
         try:
@@ -294,6 +799,14 @@ class CRUD:
         except Exception as e:
             self._exc(e)
 
+    def get_timetable_many(self, prompt_ids: list) -> Dict[int, List[Dict]]:
+        "timetables of page of prompts, one query -> {prompt_id: [timetable]}"
+        try:
+            return self._children(m.Timetable, "prompt_id", prompt_ids)
+
+        except Exception as e:
+            self._exc(e)
+
     def add_timetable(self, prompt_id, day, hour, minute, tz) -> Dict:
         def time_convert(tz, d, h):
             "convert D-days('1357') and h-hours according to tz-timezone"
@@ -320,6 +833,7 @@ class CRUD:
                 hour=hour,
                 minute=minute,
                 timezone=tz,
+                next_run_at=next_run_at(du, hu, minute, int(time())),
             )
             self.__db.session.add(res)
             self.__db.session.commit()
@@ -342,63 +856,85 @@ class CRUD:
         except Exception as e:
             self._exc(e, rb=True)
 
-    def get_event_all(self, day: int, hour: int, min: int) -> List[Dict]:
+    def claim_due_timetables(self, now: int, catchup: int) -> List[Dict]:
         # used_by gpt
-        """get events from db 'timetable' for the given UTC day, hour, minute
-        [{'user_id': int, 'prompt_id': int}, {}...]"""
-        try:  # Prompt.id == Timetable.prompt_id
-            res = (
-                self.__db.session.query(m.Prompt, m.Timetable)
-                .join(m.Timetable)
-                .filter(
-                    m.Timetable.day_utc.like(f"%{day}%"),
-                    m.Timetable.hour_utc == hour,
-                    m.Timetable.minute == min // 10 * 10,
+        """timetables with next_run_at <= now (index range scan): next_run_at
+        moves past now, compare-and-set - one claim for concurrent schedulers.
+        run missed by more than catchup sec is skipped.
+        -> [{'user_id', 'prompt_id', 'timetable_id', 'run_at'}, {}...]"""
+        t = m.Timetable.__table__
+        try:
+            new = self.__db.session.execute(
+                select(t.c.id, t.c.day_utc, t.c.hour_utc, t.c.minute).where(
+                    t.c.next_run_at.is_(None)
                 )
-                .group_by(m.Prompt)
-                .all()
-            )
-            events = []
-            for i in res:
-                events.append({"user_id": i.Prompt.user_id, "prompt_id": i.Prompt.id})
-                print(
-                    "queries: Prompt >>",
-                    i.Prompt.as_dict(),
-                    "\nqueries: Tmtb >>",
-                    i.Timetable.as_dict(),
-                    "\n------",
+            ).all()  # timetables added before next_run_at
+            for i in new:
+                self.__db.session.execute(
+                    update(t)
+                    .where(t.c.id == i.id)
+                    .values(next_run_at=next_run_at(*i[1:], now - catchup))
                 )
-            print("queries: Events >>", events)
-            return events
+
+            rows = self.__db.session.execute(
+                select(
+                    t.c.id,
+                    t.c.prompt_id,
+                    m.Prompt.user_id,
+                    t.c.day_utc,
+                    t.c.hour_utc,
+                    t.c.minute,
+                    t.c.next_run_at,
+                )
+                .join(m.Prompt, m.Prompt.id == t.c.prompt_id)
+                .where(t.c.next_run_at <= now)
+                .order_by(t.c.next_run_at)
+            ).all()
+            due = []
+            for i in rows:
+                claimed = self.__db.session.execute(
+                    update(t)
+                    .where(t.c.id == i.id, t.c.next_run_at == i.next_run_at)
+                    .values(
+                        next_run_at=next_run_at(i.day_utc, i.hour_utc, i.minute, now)
+                    )
+                ).rowcount
+                if not claimed:  # taken by other scheduler
+                    continue
+                if now - i.next_run_at > catchup:
+                    logger.warning(f"TIMETABLE {i.id}: run at {i.next_run_at} missed")
+                    continue
+                due.append(
+                    {
+                        "user_id": i.user_id,
+                        "prompt_id": i.prompt_id,
+                        "timetable_id": i.id,
+                        "run_at": i.next_run_at,
+                    }
+                )
+            self.__db.session.commit()
+            return due
 
         except Exception as e:
-            self._exc(e)
+            self._exc(e, rb=True)
 
     # Content
     def get_content_all(self, user_id, filter: dict) -> Dict:
-        """filter dict: {'limit': 100, 'page': 1}
-        -> Dict.keys: 'list', 'totalPage', 'currentPage'"""
-        lim = int(filter.get("limit", 100))
-        current_page = int(filter.get("page", 1))
-        offset = (current_page - 1) * lim
+        """filter dict: {'limit': 100, 'after_id' | 'before_id', 'count': false,
+        'prompt_id': 0} -> Dict.keys: 'list', 'afterId', 'beforeId' (see _page)"""
         prompt_id = int(filter.get("prompt_id", 0))
         try:
-            res = (
-                m.Content.query.filter_by(user_id=user_id)
-                .filter(True if prompt_id == 0 else m.Content.prompt_id == prompt_id)
-                .order_by(m.Content.id.desc())
-                .limit(lim)
-                .offset(offset)
-                .all()
-            )  # all: limit < 0, offset <= 0
-            count = (
-                m.Content.query.filter_by(user_id=user_id)
-                .filter(True if prompt_id == 0 else m.Content.prompt_id == prompt_id)
-                .count()
+            query = m.Content.query.filter_by(user_id=user_id).filter(
+                True if prompt_id == 0 else m.Content.prompt_id == prompt_id
             )
-            total_page = ceil(count / lim) if count / lim > 1 else 1
-            list_ = [i.as_dict() for i in res]
-            return {"list": list_, "totalPage": total_page, "currentPage": current_page}
+            res = self._page(
+                query,
+                m.Content,
+                filter,
+                lambda: self._content_count(user_id, prompt_id),
+            )
+            res["list"] = [i.as_dict() for i in res["list"]]
+            return res
 
         except Exception as e:
             self._exc(e)
@@ -408,12 +944,7 @@ class CRUD:
         -> dict: {'count': 1}"""
         prompt_id = int(filter.get("prompt_id", 0))
         try:
-            count = (
-                m.Content.query.filter_by(user_id=user_id)
-                .filter(True if prompt_id == 0 else m.Content.prompt_id == prompt_id)
-                .count()
-            )
-            return {"count": count}
+            return {"count": self._content_count(user_id, prompt_id)}
 
         except Exception as e:
             self._exc(e)
@@ -436,11 +967,15 @@ class CRUD:
             if not res:
                 raise ValueError("record not found in db")
 
+            post = res.post
             for k, v in attrs.items():
                 if k in getattr(res, "_protected"):
                     raise AttributeError("protected attribute")
 
                 setattr(res, k, v)
+            if res.post != post:
+                self._count_rows(user_id, "content", -1, res.prompt_id, post)
+                self._count_rows(user_id, "content", 1, res.prompt_id, res.post)
             self.__db.session.commit()
             return res.as_dict()
 
@@ -461,12 +996,80 @@ class CRUD:
                 post=post,
             )
             self.__db.session.add(res)
+            self._count_rows(user_id, "content", 1, prompt_id, post)
             self.__db.session.commit()
             return res.as_dict()
 
         except Exception as e:
             self._exc(e, rb=True)
 
+    def add_content_with_fields(
+        self, user_id, prompt_id, title, text, post="false", fields: dict = None
+    ) -> Dict:
+        # used_by gpt
+        "content + its fields {name: value} in one transaction"
+        try:
+            res = m.Content(
+                user_id=user_id,
+                prompt_id=prompt_id,
+                title=title,
+                text=text,
+                date=int(time()),
+                post=post,
+            )
+            self.__db.session.add(res)
+            self._count_rows(user_id, "content", 1, prompt_id, post)
+            self.__db.session.flush()
+            self.__db.session.add_all(
+                m.CField(content_id=res.id, name=k, value=v)
+                for k, v in (fields or {}).items()
+            )
+            self.__db.session.commit()
+            return res.as_dict()
+
+        except Exception as e:
+            self._exc(e, rb=True)
+
+    def add_content_batch(
+        self, user_id, prompt_id, contents: List[dict], used=(), release=()
+    ) -> List[int]:
+        # used_by gpt
+        """contents [{title, text, post, fields: {name: value}}, ...], claimed
+        topic ids: used (deleted) and release (free again) in one transaction.
+        -> content ids"""
+        try:
+            q = m.TopicQueue.__table__
+            if used:
+                self.__db.session.execute(delete(q).where(q.c.id.in_(used)))
+            if release:
+                self.__db.session.execute(
+                    update(q).where(q.c.id.in_(release)).values(claimed=None)
+                )
+            rows = [
+                m.Content(
+                    user_id=user_id,
+                    prompt_id=prompt_id,
+                    title=i["title"],
+                    text=i["text"],
+                    date=int(time()),
+                    post=i.get("post", "false"),
+                )
+                for i in contents
+            ]
+            self.__db.session.add_all(rows)
+            self._count_contents(rows)
+            self.__db.session.flush()
+            self.__db.session.add_all(
+                m.CField(content_id=row.id, name=k, value=v)
+                for row, i in zip(rows, contents)
+                for k, v in (i.get("fields") or {}).items()
+            )
+            self.__db.session.commit()
+            return [row.id for row in rows]
+
+        except Exception as e:
+            self._exc(e, rb=True)
+
     def del_content(self, user_id, content_id) -> None:
         try:
             res = m.Content.query.filter_by(user_id=user_id, id=content_id).first()
@@ -474,6 +1077,7 @@ class CRUD:
                 raise ValueError("record not found in db")
 
             self.__db.session.delete(res)
+            self._count_contents([res], -1)
             self.__db.session.commit()
 
         except Exception as e:
@@ -489,6 +1093,14 @@ class CRUD:
         except Exception as e:
             self._exc(e)
 
+    def get_content_field_many(self, content_ids: list) -> Dict[int, List[Dict]]:
+        "content fields of page of contents, one query -> {content_id: [cfield]}"
+        try:
+            return self._children(m.CField, "content_id", content_ids)
+
+        except Exception as e:
+            self._exc(e)
+
     def add_content_field(self, content_id, name="name", value="value") -> Dict:
         # used_by gpt & dalle
         try:
@@ -528,6 +1140,70 @@ class CRUD:
         except Exception as e:
             self._exc(e, rb=True)
 
+    # GenRun
+    def add_gen_run(self, user_id, prompt_id, topic, toc) -> Dict:
+        # used_by gpt
+        try:
+            res = m.GenRun(user_id=user_id, prompt_id=prompt_id, topic=topic, toc=toc)
+            self.__db.session.add(res)
+            self.__db.session.commit()
+            return res.as_dict()
+
+        except Exception as e:
+            self._exc(e, rb=True)
+
+    def get_gen_run(self, user_id, run_id) -> Dict:
+        # used_by gpt
+        "run + 'chapters': [chapter, ...] ordered by idx"
+        try:
+            res = m.GenRun.query.filter_by(user_id=user_id, id=run_id).first()
+            if not res:
+                raise ValueError("record not found in db")
+
+            chapters = m.GenChapter.query.filter_by(run_id=run_id).order_by(
+                m.GenChapter.idx
+            )
+            return res.as_dict() | {"chapters": [i.as_dict() for i in chapters]}
+
+        except Exception as e:
+            self._exc(e)
+
+    def save_gen_chapter(self, run_id, idx, title, text, error=None) -> None:
+        # used_by gpt
+        "chapter checkpoint: insert or replace by (run_id, idx)"
+        try:
+            res = m.GenChapter.query.filter_by(run_id=run_id, idx=idx).first()
+            if not res:
+                res = m.GenChapter(run_id=run_id, idx=idx)
+                self.__db.session.add(res)
+            res.title = title
+            res.text = text
+            res.state = "failed" if error else "done"
+            res.error = error
+            self.__db.session.commit()
+
+        except Exception as e:
+            self._exc(e, rb=True)
+
+    def finish_gen_run(self, run_id, content_id) -> Dict:
+        # used_by gpt
+        """link content. state: 'partial' if any chapter failed else 'done'.
+        done: chapter checkpoints are deleted, text is in content"""
+        try:
+            res = self.__db.session.get(m.GenRun, run_id)
+            failed = m.GenChapter.query.filter_by(run_id=run_id, state="failed")
+            res.content_id = content_id
+            res.state = "partial" if failed.first() else "done"
+            if res.state == "done":
+                self.__db.session.execute(
+                    delete(m.GenChapter).where(m.GenChapter.run_id == run_id)
+                )
+            self.__db.session.commit()
+            return res.as_dict()
+
+        except Exception as e:
+            self._exc(e, rb=True)
+
     # CField images
     def get_images_count(self, content_id) -> int:
         # used_by dalle
@@ -638,12 +1314,158 @@ class CRUD:
                 raise AttributeError("protected attribute")
 
             setattr(res, column, value)
+            bumped = self.__db.session.execute(
+                update(m.PModVersion).values(version=m.PModVersion.version + 1)
+            )
+            if not bumped.rowcount:
+                self.__db.session.add(m.PModVersion(id=1, version=1))
             self.__db.session.commit()
             return res.as_dict()
 
         except Exception as e:
             self._exc(e, rb=True)
 
+    def get_prompt_mod_version(self) -> int:
+        # used_by gpt
+        "p_mod version: one row read to check Mods cache"
+        try:
+            return (
+                self.__db.session.execute(select(m.PModVersion.version)).scalar() or 0
+            )
+
+        except Exception as e:
+            self._exc(e)
+
+    # Job
+    def add_job(self, user_id, kind: str, args: dict) -> Dict:
+        "kind: gen | topic | dalle. -> job (state 'queued')"
+        try:
+            res = m.Job(user_id=user_id, kind=kind, args=json.dumps(args))
+            self.__db.session.add(res)
+            self.__db.session.commit()
+            return res.as_dict()
+
+        except Exception as e:
+            self._exc(e, rb=True)
+
+    def get_job(self, user_id, job_id) -> Dict:
+        "fresh state from db (not from session identity map)"
+        try:
+            res = (
+                m.Job.query.filter_by(user_id=user_id, id=job_id)
+                .execution_options(populate_existing=True)
+                .first()
+            )
+            if not res:
+                raise ValueError("record not found in db")
+
+            return res.as_dict()
+
+        except Exception as e:
+            self._exc(e)
+
+    def claim_job(self, worker: str) -> Dict | None:
+        # used_by gpt_worker
+        "atomically move the oldest queued job to 'running'. -> job | None"
+        try:
+            job = m.Job.__table__
+            oldest = (
+                select(job.c.id)
+                .where(job.c.state == "queued")
+                .order_by(job.c.id)
+                .limit(1)
+                .scalar_subquery()
+            )
+            now = int(time())
+            job_id = self.__db.session.execute(
+                update(job)
+                .where(job.c.id == oldest, job.c.state == "queued")
+                .values(
+                    state="running",
+                    worker=worker,
+                    started=now,
+                    heartbeat=now,
+                    attempts=func.coalesce(job.c.attempts, 0) + 1,
+                )
+                .returning(job.c.id)
+            ).scalar()
+            self.__db.session.commit()
+            if job_id:
+                return self.__db.session.get(m.Job, job_id).as_dict()
+
+        except Exception as e:
+            self._exc(e, rb=True)
+
+    def beat_jobs(self, workers: List[str]) -> int:
+        # used_by gpt_worker
+        "refresh heartbeat of jobs running by workers. -> count"
+        if not workers:
+            return 0
+        try:
+            job = m.Job.__table__
+            res = self.__db.session.execute(
+                update(job)
+                .where(job.c.state == "running", job.c.worker.in_(workers))
+                .values(heartbeat=int(time()))
+            )
+            self.__db.session.commit()
+            return res.rowcount
+
+        except Exception as e:
+            self._exc(e, rb=True)
+
+    def finish_job(self, job_id, worker: str, result=None, error: str = None) -> bool:
+        # used_by gpt_worker
+        """state 'done' with result | 'failed' with error.
+        -> False: job was requeued and claimed by other worker, not written"""
+        try:
+            job = m.Job.__table__
+            res = self.__db.session.execute(
+                update(job)
+                .where(
+                    job.c.id == job_id,
+                    job.c.worker == worker,
+                    job.c.state == "running",
+                )
+                .values(
+                    state="failed" if error else "done",
+                    result=json.dumps(result),
+                    error=error,
+                    finished=int(time()),
+                )
+            )
+            self.__db.session.commit()
+            return bool(res.rowcount)
+
+        except Exception as e:
+            self._exc(e, rb=True)
+
+    def requeue_jobs(self, stale: int, attempts: int) -> Dict:
+        # used_by gpt_worker
+        """running jobs without heartbeat for stale sec (dead worker) -> 'queued',
+        claimed attempts times already -> 'failed'. -> {'requeued', 'failed'}"""
+        try:
+            job = m.Job.__table__
+            beat = func.coalesce(job.c.heartbeat, job.c.started)
+            lost = (job.c.state == "running") & (beat < int(time()) - stale)
+            failed = self.__db.session.execute(
+                update(job)
+                .where(lost, job.c.attempts >= attempts)
+                .values(
+                    state="failed",
+                    error=f"worker lost {attempts} times",
+                    finished=int(time()),
+                )
+            ).rowcount
+            requeued = self.__db.session.execute(
+                update(job).where(lost).values(state="queued", worker=None)
+            ).rowcount
+            self.__db.session.commit()
+            return {"requeued": requeued, "failed": failed}
+
+        except Exception as e:
+            self._exc(e, rb=True)
+
 
 crud = CRUD(m.db)
 """DB instance with query methods from db.py"""
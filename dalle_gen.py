@@ -1,25 +1,24 @@
 import os
 
-import openai
 import requests
 from loguru import logger
 
 from crud import crud
-from settings import IMG_EXT, IMG_MAX, IMG_PATH, MODEL_4K, OPENAI_KEY
+from gpt.openai import openai_request
+from settings import IMG_EXT, IMG_MAX, IMG_PATH, MODEL_4K
 from utils import invalid_user, random_chars
 
 logger = logger.bind(name="dalle")
 
-openai.api_key = OPENAI_KEY
-
 
 def create_openai_prompt_for_dalle(user_id, content_id):
     "Generate Prompt for Dall-e with Chat-GPT"
     text = crud.get_content(user_id, content_id)["text"]
     prompt = f"""Use the Text between tags '##' to create a prompt for Dall-e 
 to generate an illustration for the Text: ##{text}##"""
-    response = openai.Completion.create(
-        model=MODEL_4K, prompt=prompt, temperature=0.6, max_tokens=2048
+    response = openai_request(
+        "completions",
+        {"model": MODEL_4K, "prompt": prompt, "temperature": 0.6, "max_tokens": 2048},
     )
     # top_p=1, frequency_penalty=0, presence_penalty=0, stop=["word", "word2"]
     return response["choices"][0]["text"].strip()
@@ -27,7 +26,9 @@ to generate an illustration for the Text: ##{text}##"""
 
 def create_openai_image(content_id, prompt, number, size):
     size_x = f"{size}x{size}"
-    response = openai.Image.create(prompt=prompt, n=number, size=size_x)
+    response = openai_request(
+        "images/generations", {"prompt": prompt, "n": number, "size": size_x}
+    )
     for i in response["data"]:
         response = requests.get(i["url"])
         if response:
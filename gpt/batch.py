@@ -0,0 +1,106 @@
+import asyncio
+from copy import copy
+
+from loguru import logger
+
+from crud import crud
+from gpt.billing import billed
+from gpt.constructor import ShortreadTemplateConstructor
+from gpt.creator import Shortread, parse_mark, strip_html
+from gpt.openai import close_async_client, create_openai_completion_async
+from gpt.prompt import Context, Prompt
+from settings import BATCH_MAX, BATCH_WIDTH, TOPIC
+
+logger = logger.bind(name="gpt")
+
+
+async def batch_article(pt: Prompt, width: asyncio.Semaphore) -> dict:
+    "article + fields for pt.topic. -> content dict"
+    constructor = ShortreadTemplateConstructor(pt)
+    constructor.make_shortread()
+    async with width:
+        logger.info(f"=> BATCH TEMPLATE:\n{pt.template}")
+        pt.text = await create_openai_completion_async(
+            pt.user_id, pt.template, pt.params.tokens, cache=pt.params.cache
+        )
+        if pt.params.html:
+            pt.text = strip_html(pt.text)
+        constructor.make_shortread_fields()
+        fields_text = await create_openai_completion_async(
+            pt.user_id, pt.template, pt.params.tokens, cache=pt.params.cache
+        )
+    return {
+        "title": pt.topic,
+        "text": pt.text,
+        "post": pt.post,
+        "fields": parse_mark(fields_text),
+    }
+
+
+async def batch_articles(pts: list[Prompt], width: int) -> list[dict | Exception]:
+    "articles concurrently, max width at once. failed article -> exception"
+    semaphore = asyncio.Semaphore(width)
+    try:
+        return await asyncio.gather(
+            *[batch_article(pt, semaphore) for pt in pts], return_exceptions=True
+        )
+    finally:
+        await close_async_client()
+
+
+@billed
+def gpt_batch(
+    user_id, prompt_id, n: int = None, width: int = BATCH_WIDTH, ctx: Context = None
+) -> dict:
+    """n shortreads (default params.batch, max BATCH_MAX) from prompt topic queue.
+    topics are claimed at once; articles, fields, used topics and topics of
+    failed articles (free again) are written in one transaction. dead worker:
+    claim expires in TOPIC_CLAIM sec"""
+    ctx = ctx or Context.load(user_id, prompt_id)  # user, prompt, fields, mods once
+    invalid = ctx.invalid_user()
+    if invalid:
+        return {"message": "fail", "user": invalid}
+
+    pt = ctx.make_prompt()
+    if pt.params.longread:
+        return {"message": "fail", "batch": "shortread only"}
+
+    if pt.params.debug:
+        return Shortread(ShortreadTemplateConstructor(pt)).create()
+
+    if TOPIC not in (pt.template if pt.params.pro else pt.mods.article):
+        return {"message": "fail", "batch": f"no {TOPIC} in template"}
+
+    n = min(n or pt.params.batch, BATCH_MAX)
+    taken = crud.pop_topics(prompt_id, n, pt.params.list_order, claim=True)
+    pts = []
+    for popped in taken:
+        item = copy(pt)  # params, mods and pfields are shared
+        item.topic = popped["topic"]
+        pts.append(item)
+
+    logger.info(f"BATCH {prompt_id}: {len(taken)} topics, width {width}")
+    try:
+        results = asyncio.run(batch_articles(pts, width))
+    except BaseException:
+        crud.release_topics([i["id"] for i in taken])
+        raise
+
+    contents, used, failed = [], [], []
+    for popped, res in zip(taken, results):
+        if isinstance(res, Exception):
+            logger.opt(exception=res).error(f"BATCH {prompt_id}: {popped['topic']}")
+            failed.append(popped)
+        else:
+            contents.append(res)
+            used.append(popped["id"])
+
+    content_ids = crud.add_content_batch(
+        user_id, prompt_id, contents, used, [i["id"] for i in failed]
+    )
+    return {
+        "message": "success",
+        "content_ids": content_ids,
+        "failed": [i["topic"] for i in failed],
+        "gpt": "on",
+    }
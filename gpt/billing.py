@@ -0,0 +1,55 @@
+import inspect
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from loguru import logger
+
+from crud import crud
+
+logger = logger.bind(name="gpt")
+
+_run: ContextVar[list | None] = ContextVar("billing_run", default=None)
+
+
+def charge(user_id, tokens: int, note: str):
+    "charge user for used tokens. inside billing_run() charges are batched"
+    run = _run.get()
+    if run is None:
+        crud.add_tokens(user_id, [(-tokens, note)])
+    else:
+        run.append((user_id, -tokens, note))
+
+
+@contextmanager
+def billing_run():
+    "collect charges of one generation run and write them once at the end"
+    run = []
+    token = _run.set(run)
+    try:
+        yield run
+    finally:
+        _run.reset(token)
+        for user_id in dict.fromkeys(i[0] for i in run):
+            entries = [(t, n) for u, t, n in run if u == user_id]
+            logger.info(f"BILLING: user {user_id}, tokens {sum(t for t, _ in entries)}")
+            crud.add_tokens(user_id, entries)
+
+
+def billed(func):
+    "decorator: run func inside billing_run(). generator: until it is exhausted or closed"
+    if inspect.isgeneratorfunction(func):
+
+        @wraps(func)
+        def gen_wrapper(*args, **kwargs):
+            with billing_run():
+                yield from func(*args, **kwargs)
+
+        return gen_wrapper
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with billing_run():
+            return func(*args, **kwargs)
+
+    return wrapper
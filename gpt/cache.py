@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import sqlite3
+from time import time
+
+from loguru import logger
+
+logger = logger.bind(name="gpt")
+
+STATS = ("hits", "misses", "tokens_saved", "latency_saved")
+
+
+class CompletionCache:
+    """on-disk cache of openai completions (sqlite).\n
+    key: user, model, prompt, temperature, max_tokens (user: no free hits on
+    completions paid by other users)\n
+    eviction: ttl (seconds) and max_size (bytes) by least recently used"""
+
+    def __init__(self, path: str, ttl: int, max_size: int) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("""CREATE TABLE IF NOT EXISTS completion (
+                key TEXT PRIMARY KEY, response TEXT, tokens INTEGER,
+                latency REAL, size INTEGER, created REAL, used REAL)""")
+            con.execute(
+                "CREATE INDEX IF NOT EXISTS ix_completion_used ON completion (used)"
+            )
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value REAL)"
+            )
+            con.executemany(
+                "INSERT OR IGNORE INTO stats VALUES (?, 0)", [(i,) for i in STATS]
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def key(user_id, payload: dict) -> str:
+        "hash of user_id, model, prompt, temperature, max_tokens"
+        fields = ("model", "prompt", "temperature", "max_tokens")
+        return hashlib.sha256(
+            json.dumps([user_id, *(payload.get(i) for i in fields)]).encode()
+        ).hexdigest()
+
+    def _count(self, con: sqlite3.Connection, **values):
+        con.executemany(
+            "UPDATE stats SET value = value + ? WHERE name = ?",
+            [(v, k) for k, v in values.items()],
+        )
+
+    def get(self, user_id, payload: dict) -> dict | None:
+        "-> cached openai response of user or None"
+        key = self.key(user_id, payload)
+        now = time()
+        with self._connect() as con:
+            row = con.execute(
+                "SELECT response, tokens, latency FROM completion "
+                "WHERE key = ? AND created > ?",
+                (key, now - self.ttl),
+            ).fetchone()
+            if row is None:
+                self._count(con, misses=1)
+                return
+
+            con.execute("UPDATE completion SET used = ? WHERE key = ?", (now, key))
+            self._count(con, hits=1, tokens_saved=row[1], latency_saved=row[2])
+        logger.info(f"CACHE HIT: {row[1]} tokens, {row[2]:.2f} sec saved")
+        return json.loads(row[0])
+
+    def set(self, user_id, payload: dict, response: dict, latency: float):
+        "store openai response and evict expired and least recently used"
+        data = json.dumps(response)
+        now = time()
+        with self._connect() as con:
+            con.execute(
+                "INSERT OR REPLACE INTO completion VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self.key(user_id, payload),
+                    data,
+                    response["usage"]["total_tokens"],
+                    latency,
+                    len(data),
+                    now,
+                    now,
+                ),
+            )
+            con.execute("DELETE FROM completion WHERE created <= ?", (now - self.ttl,))
+            size = con.execute("SELECT SUM(size) FROM completion").fetchone()[0]
+            while size > self.max_size:
+                key, key_size = con.execute(
+                    "SELECT key, size FROM completion ORDER BY used LIMIT 1"
+                ).fetchone()
+                con.execute("DELETE FROM completion WHERE key = ?", (key,))
+                size -= key_size
+
+    def stats(self) -> dict:
+        "-> {'hits', 'misses', 'tokens_saved', 'latency_saved', 'entries', 'size'}"
+        with self._connect() as con:
+            res = dict(con.execute("SELECT name, value FROM stats").fetchall())
+            res["entries"], res["size"] = con.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completion"
+            ).fetchone()
+        return res
+
+    def clear(self):
+        "delete all entries and reset stats"
+        with self._connect() as con:
+            con.execute("DELETE FROM completion")
+            con.execute("UPDATE stats SET value = 0")
@@ -1,5 +1,3 @@
-import random
-
 from crud import crud
 from gpt.prompt import Prompt
 from settings import TOPIC
@@ -10,27 +8,15 @@ class Constructor:
         self.pt = pt
 
     def _use_topic_list(self):
-        "pop topic from topic_list to template"
-
-        def pop_item(lst: list, order: str) -> str:
-            "pop item from list by order [reverse | random | normal]"
-            item = "nothing"
-            if lst:
-                match order:
-                    case "reverse":
-                        item = lst.pop()
-                    case "random":
-                        item = lst.pop(random.randrange(len(lst)))
-                    case _:
-                        item = lst.pop(0)
-            return item
-
-        if self.pt.topic_list and TOPIC in self.pt.template:
-            self.pt.topic_list = [i.strip() for i in self.pt.topic_list.split(";")]
-            self.pt.topic = pop_item(
-                self.pt.topic_list, self.pt.params.list_order
-            ).strip()
-            self.pt.template = self.pt.template.replace(TOPIC, self.pt.topic)
+        "pop topic from prompt topic queue to template. pt.topic set: use it"
+        if TOPIC not in self.pt.template:
+            return
+        if not self.pt.topic:
+            popped = crud.pop_topic(self.pt.id, self.pt.params.list_order)
+            if not popped:
+                return
+            self.pt.topic, self.pt.topic_pos = popped["topic"], popped["pos"]
+        self.pt.template = self.pt.template.replace(TOPIC, self.pt.topic)
 
     def _use_seo_kw(self):
         "add keywords to template if 'seo'"
@@ -51,9 +37,11 @@ class Constructor:
 
     def _use_prompt_fields(self):
         "add prompt fields to template"
-        pfield = crud.get_prompt_field_all(self.pt.id)
-        for i in pfield:
-            self.pt.template += self.pt.mods.add_field.format(i["name"])
+        names = self.pt.pfields
+        if names is None:
+            names = [i["name"] for i in crud.get_prompt_field_all(self.pt.id)]
+        for name in names:
+            self.pt.template += self.pt.mods.add_field.format(name)
 
 
 class TopicListTemplateConstructor(Constructor):
@@ -95,6 +83,29 @@ class LongreadTemplateConstructor(Constructor):
         self._use_options(html=True)
         return self.pt.template
 
+    def make_longread_chapters(self, compact: bool | None = None) -> list[str]:
+        """templates for all chapters of self.toc. options are built once.\n
+        compact (default: params.compact_toc): TOC in chapter template keeps
+        full text of current and neighbour chapters, titles of the rest"""
+        compact = self.pt.params.compact_toc if compact is None else compact
+        toc_list = self.pt.get_toc_list()
+        titles = [i.splitlines()[0] for i in toc_list]
+        self.pt.template = ""
+        self._use_seo_kw()
+        self._use_options(html=True)
+        options = self.pt.template
+        templates = []
+        for i, chapter_title in enumerate(toc_list):
+            toc = self.pt.toc
+            if compact:
+                toc = "\n".join(
+                    ch if abs(i - j) <= 1 else titles[j]
+                    for j, ch in enumerate(toc_list)
+                )
+            templates.append(self.pt.mods.chapter.format(toc, chapter_title) + options)
+        self.pt.template = templates[-1] if templates else options
+        return templates
+
     def make_longread_fields(self):
         """template constructor uses self.toc"""
         self.pt.template = self.pt.mods.table_fields.format(self.pt.toc)
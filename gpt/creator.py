@@ -1,18 +1,29 @@
 import asyncio
+import inspect
 import re
 from abc import ABC, abstractmethod
-from time import sleep
+from functools import wraps
+from time import time
+from typing import Generator, Iterator
 
 from loguru import logger
 
 from crud import crud
+from gpt.billing import billed
 from gpt.constructor import (
     Constructor,
     LongreadTemplateConstructor,
     ShortreadTemplateConstructor,
     TopicListTemplateConstructor,
 )
-from gpt.openai import create_openai_completion, create_openai_completion_async
+from gpt.openai import (
+    close_async_client,
+    count_tokens,
+    create_openai_completion,
+    create_openai_completion_async,
+    stream_openai_completion,
+)
+from settings import STREAM_FLUSH
 
 logger = logger.bind(name="gpt")
 
@@ -26,20 +37,92 @@ def strip_html(text: str, tag="body") -> str:
     return text[start:end].strip()
 
 
+MARK = re.compile(r"##[\w:-]+")  ##mark## pattern = "##(.*?)##"; match.group(1)
+
+
+class MarkParser:
+    """single pass parser of text by mark: ##mark. works on streamed chunks:
+    feed(chunk)... close() -> {mark: text}. keeps only current field in memory"""
+
+    def __init__(self) -> None:
+        self.result: dict[str, str] = {}
+        self.key: str | None = None
+        self.parts: list[str] = []  # text of current mark
+        self.carry = ""  # tail that can be a part of the next mark
+
+    def _field(self, text: str):
+        if self.key is not None:
+            self.parts.append(text)
+
+    def _close_field(self) -> dict[str, str]:
+        if self.key is None:
+            return {}
+        value = "".join(self.parts).strip(" \n'\";:.,")
+        self.result[self.key] = value
+        self.parts = []
+        return {self.key: value}
+
+    def _scan(self, text: str, matches: list[re.Match], end: int) -> dict[str, str]:
+        "text[:end] with its marks. -> fields closed"
+        closed = {}
+        start = 0
+        for match in matches:
+            self._field(text[start : match.start()])
+            closed |= self._close_field()
+            self.key = match.group(0).strip("#:-")
+            start = match.end()
+        self._field(text[start:end])
+        return closed
+
+    def feed(self, chunk: str) -> dict[str, str]:
+        "-> fields closed by chunk"
+        text = self.carry + chunk
+        matches = list(MARK.finditer(text))
+        end = len(text) - min(len(text) - len(text.rstrip("#")), 2)  # '#', '##'
+        if matches and matches[-1].end() == len(text):  # mark may go on
+            end = matches.pop().start()
+        self.carry = text[end:]
+        return self._scan(text, matches, end)
+
+    def close(self) -> dict[str, str]:
+        "-> all fields"
+        text, self.carry = self.carry, ""
+        self._scan(text, list(MARK.finditer(text)), len(text))
+        self._close_field()
+        return self.result
+
+
 def parse_mark(text: str) -> dict[str, str]:
     "parse text by mark: ##mark"
-    pattern = "##[\w:-]+"  ##mark## pattern = "##(.*?)##"; match.group(1)
-    result = {}
-    for match in re.finditer(pattern, text):
-        key = match.group(0)
-        content_start = match.end()
-        next_match = re.search(pattern, text[content_start:])
-        content_end = (
-            len(text) if next_match is None else next_match.start() + content_start
-        )
-        content = text[content_start:content_end]
-        result[key.strip("#:-")] = content.strip(" \n'\";:.,")
-    return result
+    parser = MarkParser()
+    parser.feed(text)
+    return parser.close()
+
+
+def release_topic(func):
+    """decorator: failed create() puts popped topic back to topic queue.\n
+    generator: also when closed early (client disconnect)"""
+    if inspect.isgeneratorfunction(func):
+
+        @wraps(func)
+        def gen_wrapper(self, *args, **kwargs):
+            try:
+                yield from func(self, *args, **kwargs)
+            except BaseException:
+                self.constructor.pt.release_topic()
+                raise
+
+        return gen_wrapper
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        except Exception:
+            self.constructor.pt.release_topic()
+            raise
+
+    return wrapper
 
 
 class Creator(ABC):
@@ -58,7 +141,8 @@ class Creator(ABC):
 
 class Mixin:
     """def write_to_db()\n
-    def create_content_fields()"""
+    def create_content_fields()\n
+    def stream_to_db()"""
 
     constructor: Constructor
 
@@ -81,6 +165,7 @@ class Mixin:
             self.constructor.pt.user_id,
             self.constructor.pt.template,
             self.constructor.pt.params.tokens,
+            cache=self.constructor.pt.params.cache,
         )
 
         logger.info(f"=> Field_text:\n{fields_text}")
@@ -90,6 +175,31 @@ class Mixin:
         for k, v in fields_dict.items():
             crud.add_content_field(content_id, k, v)
 
+    def stream_to_db(
+        self, content_id, chunks: Iterator[str], text=""
+    ) -> Generator[tuple[str, str], None, str]:
+        """yield ('text', chunk) and write partial text to content
+        every STREAM_FLUSH sec. -> text + all chunks"""
+        flushed = time()
+        for chunk in chunks:
+            text += chunk
+            yield "text", chunk
+            if time() - flushed > STREAM_FLUSH:
+                crud.edit_content(
+                    self.constructor.pt.user_id, content_id, {"text": text}
+                )
+                flushed = time()
+        crud.edit_content(self.constructor.pt.user_id, content_id, {"text": text})
+        return text
+
+    def stream_completion(self) -> Iterator[str]:
+        "stream_openai_completion() for pt.template"
+        return stream_openai_completion(
+            self.constructor.pt.user_id,
+            self.constructor.pt.template,
+            self.constructor.pt.params.tokens,
+        )
+
 
 class TopicList(Creator):
     constructor: TopicListTemplateConstructor
@@ -98,6 +208,7 @@ class TopicList(Creator):
         self.constructor = constructor
         self.topic = topic
 
+    @billed
     def create(self) -> list[str]:
         super().create()
         self.constructor.make_topic_list(self.topic)
@@ -110,6 +221,7 @@ class TopicList(Creator):
             self.constructor.pt.user_id,
             self.constructor.pt.template,
             self.constructor.pt.params.tokens,
+            cache=self.constructor.pt.params.cache,
         )
         logger.debug(self.constructor.pt.toc)
         return self.constructor.pt.get_toc_list(numbered=False)
@@ -121,6 +233,8 @@ class Shortread(Mixin, Creator):
     def __init__(self, constructor: ShortreadTemplateConstructor) -> None:
         self.constructor = constructor
 
+    @billed
+    @release_topic
     def create(self):
         super().create()
         self.constructor.make_shortread()
@@ -129,8 +243,37 @@ class Shortread(Mixin, Creator):
 
         return self.shortread()
 
+    @billed
+    @release_topic
+    def stream(self) -> Iterator[tuple[str, dict | str]]:
+        """streaming create(). yield events:
+        ('content', {'content_id'}), ('text', chunk)..., ('done', result)"""
+        super().create()
+        self.constructor.make_shortread()
+        if self.constructor.pt.params.debug:
+            yield "done", self.debug_shortread()
+            return
+
+        pt = self.constructor.pt
+        last_content_id = self.content_to_db(title=pt.topic, text="", post=pt.post)
+        pt.topic_pos = None  # content has the topic: failed stream keeps it
+        yield "content", {"content_id": last_content_id}
+
+        logger.info(f"=> TEMPLATE:\n{pt.template}")
+        pt.text = yield from self.stream_to_db(
+            last_content_id, self.stream_completion()
+        )
+        if pt.params.html:
+            self.strip_html()
+            crud.edit_content(pt.user_id, last_content_id, {"text": pt.text})
+
+        self.constructor.make_shortread_fields()
+        self.create_content_fields(last_content_id)
+        yield "done", {"message": "success", "content_id": last_content_id, "gpt": "on"}
+
     def debug_shortread(self) -> dict:
-        "write all shortread templates to DB content"
+        "write all shortread templates to DB content. topic is not used up"
+        self.constructor.pt.release_topic()
         text = self.constructor.pt.template
         self.constructor.make_shortread_fields()
         text += "\n\n===================\n\n" + self.constructor.pt.template
@@ -148,8 +291,8 @@ class Shortread(Mixin, Creator):
             text=self.constructor.pt.text,
             post=self.constructor.pt.post,
         )
+        self.constructor.pt.topic_pos = None  # used up: failed fields keep it
 
-        self.constructor.pt.write_topic_list()
         self.constructor.make_shortread_fields()
         self.create_content_fields(last_content_id)
         return {"message": "success", "content_id": last_content_id, "gpt": "on"}
@@ -161,6 +304,7 @@ class Shortread(Mixin, Creator):
             self.constructor.pt.user_id,
             self.constructor.pt.template,
             self.constructor.pt.params.tokens,
+            cache=self.constructor.pt.params.cache,
         )
         self.strip_html()
 
@@ -176,6 +320,8 @@ class Longread(Mixin, Creator):
     def __init__(self, constructor: LongreadTemplateConstructor) -> None:
         self.constructor = constructor
 
+    @billed
+    @release_topic
     def create(self):
         super().create()
         self.constructor.make_longread_table()
@@ -184,12 +330,52 @@ class Longread(Mixin, Creator):
 
         return self.longread()
 
+    @billed
+    @release_topic
+    def stream(self) -> Iterator[tuple[str, dict | str]]:
+        """streaming create(). TOC, then chapters one by one. yield events:
+        ('content', {'content_id'}), ('text', chunk)..., ('done', result)"""
+        super().create()
+        self.constructor.make_longread_table()
+        if self.constructor.pt.params.debug:
+            yield "done", self.debug_longread()
+            return
+
+        pt = self.constructor.pt
+        last_content_id = self.content_to_db(title=pt.topic, text="", post=pt.post)
+        pt.topic_pos = None  # content has the topic: failed stream keeps it
+        yield "content", {"content_id": last_content_id}
+
+        logger.info(f"=> TABLE TEMPLATE:\n{pt.template}")
+        pt.toc = yield from self.stream_to_db(last_content_id, self.stream_completion())
+        pt.text = pt.toc
+        self.toc_to_html()
+        templates = self.constructor.make_longread_chapters()  # use pt.toc
+        for ch_title, template in zip(pt.get_toc_list(), templates):
+            pt.template = template  # for stream_completion()
+            if pt.params.html:
+                ch_title = "<h2>" + ch_title + "</h2>"
+            yield "text", "\n\n" + ch_title + "\n\n"
+            start = len(pt.text) + len(ch_title) + 4
+            pt.text = yield from self.stream_to_db(
+                last_content_id,
+                self.stream_completion(),
+                pt.text + "\n\n" + ch_title + "\n\n",
+            )
+            if pt.params.html:
+                pt.text = pt.text[:start] + strip_html(pt.text[start:])
+        crud.edit_content(pt.user_id, last_content_id, {"text": pt.text})
+
+        self.constructor.make_longread_fields()
+        self.create_content_fields(last_content_id)
+        yield "done", {"message": "success", "content_id": last_content_id, "gpt": "on"}
+
     def debug_longread(self) -> dict:
-        "write all longread templates to DB content"
+        "write all longread templates to DB content. topic is not used up"
+        self.constructor.pt.release_topic()
         text = self.constructor.pt.template
-        chapters = self.constructor.pt.get_toc_list()
-        self.constructor.make_longread_chapter(chapters[0])
-        text += "\n\n===================\n\n" + self.constructor.pt.template
+        chapters = self.constructor.make_longread_chapters()  # as longread() sends
+        text += "\n\n===================\n\n" + chapters[0]
         self.constructor.make_longread_fields()
         text += "\n\n===================\n\n" + self.constructor.pt.template
         last_content_id = self.content_to_db(title="DEBUG: gpt off", text=text)
@@ -200,19 +386,98 @@ class Longread(Mixin, Creator):
         }
 
     def longread(self) -> dict:
+        "TOC -> chapters and fields concurrently (both use pt.toc) -> one write"
         self.create_toc()
-        chapters_list: list[str] = asyncio.run(self.make_chapters())
-        self.constructor.pt.text += "\n\n" + "\n\n".join(chapters_list)
-        last_content_id = self.content_to_db(
-            title=self.constructor.pt.topic,
-            text=self.constructor.pt.text,
-            post=self.constructor.pt.post,
+        pt = self.constructor.pt
+        run = crud.add_gen_run(pt.user_id, pt.id, pt.topic, pt.toc)  # checkpoint
+        pt.topic_pos = None  # topic belongs to run: resumable, not released
+        chapters_list, fields = asyncio.run(self.make_body(run["id"]))
+        pt.text += "\n\n" + "\n\n".join(chapters_list)
+        last_content = crud.add_content_with_fields(
+            user_id=pt.user_id,
+            prompt_id=pt.id,
+            title=pt.topic,
+            text=pt.text,
+            post=pt.post,
+            fields=fields,
         )
+        crud.finish_gen_run(run["id"], last_content["id"])
+        return {
+            "message": "success",
+            "content_id": last_content["id"],
+            "run_id": run["id"],
+            "gpt": "on",
+        }
+
+    @billed
+    def resume(self, run: dict) -> dict:
+        """regenerate missing and failed chapters of run (crud.get_gen_run),
+        reassemble content. fields only if content was not written"""
+        super().create()
+        pt = self.constructor.pt
+        pt.topic, pt.toc = run["topic"], run["toc"]
+        pt.text = pt.toc
+        self.toc_to_html()
+        done = {i["idx"]: i["text"] for i in run["chapters"] if i["state"] == "done"}
+        todo = [i for i in range(len(pt.get_toc_list())) if i not in done]
+        logger.info(f"RESUME run {run['id']}: chapters {todo}")
 
-        self.constructor.pt.write_topic_list()
+        chapters, fields = asyncio.run(
+            self.make_body(run["id"], todo, fields=not run["content_id"])
+        )
+        done.update(zip(todo, chapters))
+        pt.text += "\n\n" + "\n\n".join(done[i] for i in sorted(done))
+        content_id = run["content_id"]
+        if content_id:
+            crud.edit_content(pt.user_id, content_id, {"text": pt.text})
+        else:
+            content_id = crud.add_content_with_fields(
+                user_id=pt.user_id,
+                prompt_id=pt.id,
+                title=pt.topic,
+                text=pt.text,
+                post=pt.post,
+                fields=fields,
+            )["id"]
+        crud.finish_gen_run(run["id"], content_id)
+        return {
+            "message": "success",
+            "content_id": content_id,
+            "resumed": todo,
+            "gpt": "on",
+        }
+
+    async def make_body(
+        self, run_id=None, indexes: list[int] = None, fields=True
+    ) -> tuple[list[str], dict[str, str]]:
+        "chapters and fields at once. -> (chapters, fields)"
+        try:
+            tasks = [self.make_chapters(run_id, indexes)]
+            if fields:
+                tasks.append(self.make_fields())
+            res = await asyncio.gather(*tasks)
+            return res[0], res[1] if fields else {}
+        finally:
+            await close_async_client()
+
+    async def make_fields(self) -> dict[str, str]:
+        "fields by TOC. error -> no fields, chapters are kept"
         self.constructor.make_longread_fields()
-        self.create_content_fields(last_content_id)
-        return {"message": "success", "content_id": last_content_id, "gpt": "on"}
+        template = self.constructor.pt.template  # before await: pt is shared
+        logger.info(f"=> Field_template:\n{template}")
+        try:
+            fields_text = await create_openai_completion_async(
+                self.constructor.pt.user_id,
+                template,
+                self.constructor.pt.params.tokens,
+                cache=self.constructor.pt.params.cache,
+            )
+        except Exception as e:
+            logger.exception(e)
+            return {}
+
+        logger.info(f"=> Field_text:\n{fields_text}")
+        return parse_mark(fields_text)
 
     def create_toc(self):
         "create toc and put into pt.text"
@@ -222,6 +487,7 @@ class Longread(Mixin, Creator):
             self.constructor.pt.user_id,
             self.constructor.pt.template,
             self.constructor.pt.params.tokens,
+            cache=self.constructor.pt.params.cache,
         )
         logger.info(self.constructor.pt.toc)
         self.constructor.pt.text = self.constructor.pt.toc
@@ -236,36 +502,52 @@ class Longread(Mixin, Creator):
             )
             logger.debug(f"TEXT TABLE TO HTML:\n{self.constructor.pt.text}")
 
-    async def make_one_chapter(self, ch_title: str) -> str:
-        "create and return chapter"
-        ch_template = self.constructor.make_longread_chapter(ch_title)  # use pt.toc
+    async def make_one_chapter(
+        self, ch_title: str, ch_template: str, run_id=None, idx=0
+    ) -> str:
+        "create and return chapter. run_id: save chapter checkpoint"
         logger.debug(f"=> CHAPTER TEMPLATE:\n{ch_template}")
         logger.info(f"=> CHAPTER {ch_title}:")
-        for _ in range(3):  # attempts
-            try:
-                chapter = await create_openai_completion_async(
-                    self.constructor.pt.user_id,
-                    ch_template,
-                    self.constructor.pt.params.tokens,
-                )
-                logger.info(chapter)
-                if self.constructor.pt.params.html:
-                    chapter = strip_html(chapter)
-                    ch_title = "<h2>" + ch_title + "</h2>"
-                break
-
-            except Exception as e:
-                chapter = "\_(o_O)_/ " + str(e)
-                sleep(2)
-
-        return ch_title + "\n\n" + chapter
-
-    async def make_chapters(self) -> list[str]:
-        "async create and return list with chapters"
+        error = None
+        try:  # retries: openai_request_async()
+            chapter = await create_openai_completion_async(
+                self.constructor.pt.user_id,
+                ch_template,
+                self.constructor.pt.params.tokens,
+                cache=self.constructor.pt.params.cache,
+            )
+            logger.info(chapter)
+            if self.constructor.pt.params.html:
+                chapter = strip_html(chapter)
+                ch_title = "<h2>" + ch_title + "</h2>"
+
+        except Exception as e:
+            logger.exception(e)
+            error = str(e) or repr(e)
+            chapter = "\_(o_O)_/ " + str(e)
+
+        text = ch_title + "\n\n" + chapter
+        if run_id:
+            crud.save_gen_chapter(run_id, idx, ch_title, text, error)
+        return text
+
+    async def make_chapters(self, run_id=None, indexes: list[int] = None) -> list[str]:
+        """async create and return list with chapters. chapters share one connection pool.
+        indexes: only these chapters of TOC (default: all)"""
+        titles = self.constructor.pt.get_toc_list()
+        templates = self.constructor.make_longread_chapters()  # use pt.toc
+        indexes = range(len(titles)) if indexes is None else indexes
+        counts = count_tokens([templates[i] for i in indexes])  # one batch
+        if self.constructor.pt.params.compact_toc:
+            full = count_tokens(self.constructor.make_longread_chapters(compact=False))
+            full = [full[i] for i in indexes]
+            for i, n, n_full in zip(indexes, counts, full):
+                logger.info(f"COMPACT TOC: {n_full - n} tokens saved: {titles[i]}")
+            logger.info(f"COMPACT TOC: {sum(full) - sum(counts)} tokens saved")
         return await asyncio.gather(
             *[
-                self.make_one_chapter(ch_title)
-                for ch_title in self.constructor.pt.get_toc_list()
+                self.make_one_chapter(titles[i], templates[i], run_id, i)
+                for i in indexes
             ]
         )
 
@@ -0,0 +1,163 @@
+import statistics
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from threading import Condition, Thread
+from time import time
+from typing import Callable
+
+from loguru import logger
+
+logger = logger.bind(name="gpt")
+
+
+@dataclass
+class Task:
+    "state: queued | running | done | failed | expired | timeout"
+
+    key: tuple
+    func: Callable
+    deadline: float | None
+    queued: float
+    started: float = 0
+    finished: float = 0
+    state: str = "queued"
+
+    @property
+    def wait(self) -> float:
+        "sec in queue"
+        return (self.started or self.finished) - self.queued
+
+    @property
+    def exec(self) -> float:
+        "sec of execution"
+        if self.state in ("done", "failed", "timeout"):
+            return self.finished - self.started
+        return 0
+
+
+class Dispatcher:
+    """run tasks concurrently: max workers in total, max per_user for one user_id.\n
+    task not started before its deadline expires; same key never runs twice at once.
+    waiting tasks of a busy user do not hold pool threads. task running over
+    timeout sec: its key and user slot are released (thread can not be killed,
+    it keeps its pool thread until it returns)"""
+
+    def __init__(
+        self, workers: int, per_user: int, name: str = "dispatch", timeout=None
+    ) -> None:
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix=name)
+        self.per_user = per_user
+        self.active = defaultdict(int)  # user_id: tasks given to pool
+        self.waiting = defaultdict(deque)  # user_id: tasks over per_user limit
+        self.keys = set()  # keys queued or running
+        self.pending = 0
+        self.tasks: list[Task] = []  # finished, for summary()
+        self.running = {}  # key: (user_id, task) for timeout
+        self.timeout = timeout
+        self.closed = False
+        self.cond = Condition()
+        if timeout:
+            Thread(target=self._watch, name=f"{name}-watch", daemon=True).start()
+
+    def submit(self, user_id, key: tuple, func: Callable, deadline=None) -> bool:
+        "queue func(). deadline: timestamp. -> False if key is queued or running"
+        with self.cond:
+            if key in self.keys:
+                logger.warning(f"DISPATCH {key}: still queued or running, skipped")
+                return False
+
+            self.keys.add(key)
+            self.pending += 1
+            task = Task(key, func, deadline, time())
+            if self.active[user_id] < self.per_user:
+                self.active[user_id] += 1
+                self.pool.submit(self._run, user_id, task)
+            else:
+                self.waiting[user_id].append(task)
+            return True
+
+    def _run(self, user_id, task: Task):
+        task.started = time()
+        state = "expired"
+        try:
+            if not task.deadline or task.started <= task.deadline:
+                with self.cond:
+                    task.state = "running"
+                    self.running[task.key] = (user_id, task)
+                task.func()
+                state = "done"
+        except Exception as e:
+            state = "failed"
+            logger.exception(e)
+        finally:
+            with self.cond:
+                if task.state == "timeout":  # already released by _watch()
+                    logger.warning(f"DISPATCH {task.key}: {state} after timeout")
+                else:
+                    task.state = state
+                    task.finished = time()
+                    self._release(user_id, task)
+
+    def _release(self, user_id, task: Task):
+        "finished task: free its key and user slot. call with self.cond"
+        logger.info(
+            f"DISPATCH {task.key}: {task.state}, "
+            f"wait {task.wait:.2f} sec, exec {task.exec:.2f} sec"
+        )
+        self.running.pop(task.key, None)
+        self.keys.discard(task.key)
+        self.tasks.append(task)
+        self.pending -= 1
+        if self.waiting[user_id]:  # user slot goes to the next user task
+            self.pool.submit(self._run, user_id, self.waiting[user_id].popleft())
+        else:
+            del self.waiting[user_id]
+            self.active[user_id] -= 1
+            if not self.active[user_id]:
+                del self.active[user_id]
+        self.cond.notify_all()
+
+    def _watch(self):
+        "release tasks running over timeout"
+        with self.cond:
+            while not self.closed:
+                now = time()
+                for user_id, task in list(self.running.values()):
+                    if now - task.started > self.timeout:
+                        logger.error(f"DISPATCH {task.key}: over {self.timeout} sec")
+                        task.state = "timeout"
+                        task.finished = now
+                        self._release(user_id, task)
+                self.cond.wait(min(self.timeout, 1))
+
+    def join(self, timeout: float = None) -> bool:
+        "wait for all submitted tasks. -> False on timeout"
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.pending, timeout)
+
+    def summary(self, reset: bool = True) -> dict:
+        "states count + queue wait / execution time (p50, max) of finished tasks"
+        with self.cond:
+            tasks = self.tasks
+            if reset:
+                self.tasks = []
+        res = dict(Counter(i.state for i in tasks))
+        for name in ("wait", "exec"):
+            values = [getattr(i, name) for i in tasks] or [0]
+            res[name] = {
+                "p50": round(statistics.median(values), 2),
+                "max": round(max(values), 2),
+            }
+        return res
+
+    def shutdown(self):
+        "drop tasks waiting for user slot, finish running ones"
+        with self.cond:
+            self.closed = True
+            for user_tasks in self.waiting.values():
+                for task in user_tasks:
+                    self.keys.discard(task.key)
+                    self.pending -= 1
+            self.waiting.clear()
+        self.pool.shutdown(wait=True, cancel_futures=True)
@@ -1,37 +1,193 @@
 import asyncio
+import importlib.util
+import json
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from time import sleep, time
+from typing import Iterator
+from weakref import WeakKeyDictionary
 
-import openai
+import httpx
 import tiktoken
 from loguru import logger
 
-from crud import crud
-from settings import MODEL_4K, MODEL_16K, OPENAI_KEY
+from gpt.billing import charge
+from gpt.cache import CompletionCache
+from gpt.ratelimit import RateLimiter
+from gpt.retry import RetryPolicy
+from settings import (
+    CONTINUE_MAX,
+    CONTINUE_OVERLAP,
+    GPT_CACHE,
+    GPT_CACHE_PATH,
+    GPT_CACHE_SIZE,
+    GPT_CACHE_TTL,
+    IMG_RPM,
+    MODEL_4K,
+    MODEL_16K,
+    OPENAI_KEY,
+    OPENAI_LIMITS,
+    OPENAI_POOL,
+    OPENAI_RPM,
+    OPENAI_TIMEOUT,
+    OPENAI_TPM,
+    OPENAI_URL,
+    RATELIMIT_PATH,
+    RETRY_ATTEMPTS,
+    RETRY_BASE,
+    RETRY_CAP,
+    TOKENIZER_THREADS,
+)
 
 logger = logger.bind(name="gpt")
-openai.api_key = OPENAI_KEY
 
+TOKEN_CACHE_SIZE = 256
 
-def count_token(s: str) -> int:
-    # encoding = tiktoken.encoding_for_model(model)
-    encoding = tiktoken.get_encoding("cl100k_base")  # big base
-    return len(encoding.encode(s))
+_token_cache: OrderedDict[str, int] = OrderedDict()  # prompt -> tokens
+_token_lock = Lock()
 
+completion_cache = (
+    CompletionCache(GPT_CACHE_PATH, GPT_CACHE_TTL, GPT_CACHE_SIZE)
+    if GPT_CACHE
+    else None
+)
+"opt-in on-disk cache of completions. settings: GPT_CACHE=true"
 
-def create_openai_completion(user_id, prompt, tokens, lvl=0) -> str:
-    """
-    send prompt to openai. return openai response. max lvl of recursion is 3\n
-    $0.0020 / 1K tokens\n
-    gpt-3.5-turbo-1106" is the flagship model of this family, supports a 16K context window and is optimized for dialog.\n
-    gpt-3.5-turbo-instruct" is an Instruct model and only supports a 4K context window.\n
-    https://openai.com/pricing\n
-    """
+rate_limiter = RateLimiter(
+    RATELIMIT_PATH,
+    {k: tuple(v) for k, v in OPENAI_LIMITS.items()} | {"images": (IMG_RPM, 1)},
+    (OPENAI_RPM, OPENAI_TPM),
+)
+"rpm/tpm token buckets shared by all processes"
+
+retry_policy = RetryPolicy(RETRY_ATTEMPTS, RETRY_BASE, RETRY_CAP)
+"backoff for openai requests: completions, chapters, dalle"
+
+HTTP2 = importlib.util.find_spec("h2") is not None  # pip install httpx[http2]
+
+_encoding: tiktoken.Encoding | None = None
+_encoding_lock = Lock()
+_client: httpx.Client | None = None
+_client_lock = Lock()
+_async_clients: WeakKeyDictionary = WeakKeyDictionary()  # event loop -> client
+
+
+def _client_kwargs() -> dict:
+    return dict(
+        base_url=OPENAI_URL,
+        headers={"Authorization": f"Bearer {OPENAI_KEY}"},
+        timeout=OPENAI_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=OPENAI_POOL, max_keepalive_connections=OPENAI_POOL
+        ),
+        http2=HTTP2,
+    )
+
+
+def get_client() -> httpx.Client:
+    "shared sync client. one keep-alive connection pool per process"
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = httpx.Client(**_client_kwargs())
+        return _client
+
+
+def get_async_client() -> httpx.AsyncClient:
+    "shared async client. one keep-alive connection pool per running event loop"
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = httpx.AsyncClient(**_client_kwargs())
+    return client
+
+
+async def close_async_client():
+    "close connection pool of the running event loop. call before loop is closed"
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def _rate_key(endpoint: str, payload: dict) -> tuple[str, int]:
+    "-> (rate limit key: model | 'images', tokens: prompt + max_tokens)"
+    if "model" not in payload:
+        return endpoint.split("/")[0], 0
+
+    tokens = count_token(payload["prompt"]) + payload.get("max_tokens", 0)
+    return payload["model"], tokens
 
-    max_lvl = 3
-    if lvl > max_lvl:  # max level of recursion
-        raise Exception(
-            f"Generation interrupt. Finish reason: max lvl of recursion is {max_lvl}"
+
+def _post(endpoint: str, payload: dict) -> dict:
+    rate_limiter.acquire(*_rate_key(endpoint, payload))
+    response = get_client().post(endpoint, json=payload)
+    response.raise_for_status()
+    return response.json()
+
+
+async def _post_async(endpoint: str, payload: dict) -> dict:
+    await rate_limiter.acquire_async(*_rate_key(endpoint, payload))
+    response = await get_async_client().post(endpoint, json=payload)
+    response.raise_for_status()
+    return response.json()
+
+
+def openai_request(endpoint: str, payload: dict) -> dict:
+    """POST payload to openai endpoint: 'completions' | 'images/generations'.\n
+    retryable errors are retried by retry_policy"""
+    return retry_policy.call(_post, endpoint, payload)
+
+
+async def openai_request_async(endpoint: str, payload: dict) -> dict:
+    "async openai_request(). waits between retries with asyncio.sleep"
+    return await retry_policy.call_async(_post_async, endpoint, payload)
+
+
+def get_encoding() -> tiktoken.Encoding:
+    """one tokenizer per process, loaded on first count: import works offline.
+    tiktoken downloads it once to TIKTOKEN_CACHE_DIR (default: temp dir)"""
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            # tiktoken.encoding_for_model(model)
+            _encoding = tiktoken.get_encoding("cl100k_base")  # big base
+        return _encoding
+
+
+def _cache_tokens(s: str, n: int):
+    with _token_lock:
+        _token_cache[s] = n
+        _token_cache.move_to_end(s)
+        if len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+
+
+def count_token(s: str) -> int:
+    "count tokens of one prompt. uses counts cached by count_tokens()"
+    with _token_lock:
+        n = _token_cache.get(s)
+    if n is None:
+        n = len(get_encoding().encode_ordinary(s))
+        _cache_tokens(s, n)
+    return n
+
+
+def count_tokens(texts: list[str]) -> list[int]:
+    "count tokens of many prompts at once (encode_batch on threads)"
+    counts = [
+        len(tokens)
+        for tokens in get_encoding().encode_ordinary_batch(
+            texts, num_threads=TOKENIZER_THREADS
         )
+    ]
+    for s, n in zip(texts, counts):
+        _cache_tokens(s, n)
+    return counts
+
 
+def _completion_payload(prompt, tokens) -> dict:
+    "choose model by prompt length. return request payload"
     model = MODEL_4K
     max_tokens = 4096
     response_tokens = max_tokens - count_token(prompt)
@@ -40,36 +196,276 @@ def create_openai_completion(user_id, prompt, tokens, lvl=0) -> str:
         max_tokens = 16384
 
     tokens = min(response_tokens, tokens)
-    # raise Exception("Stop before openai.Completion.create")
-    response = openai.Completion.create(
-        model=model,
-        prompt=prompt,
-        temperature=0.6,
-        max_tokens=tokens,  # default: 2048
-        # top_p=1,
-        # frequency_penalty=0,
-        # presence_penalty=0,
-        # stop=["word", "word2"],
-    )
+    return {
+        "model": model,
+        "prompt": prompt,
+        "temperature": 0.6,
+        "max_tokens": tokens,  # default: 2048
+        # "top_p": 1,
+        # "frequency_penalty": 0,
+        # "presence_penalty": 0,
+        # "stop": ["word", "word2"],
+    }
+
+
+def _request_completion(user_id, payload, cache) -> tuple[dict, bool]:
+    "-> (response, cached)"
+    if cache and completion_cache:
+        response = completion_cache.get(user_id, payload)
+        if response is not None:
+            return response, True
+
+    start = time()
+    response = openai_request("completions", payload)
+    if cache and completion_cache:
+        completion_cache.set(user_id, payload, response, time() - start)
+    return response, False
+
+
+async def _request_completion_async(user_id, payload, cache) -> tuple[dict, bool]:
+    "-> (response, cached)"
+    if cache and completion_cache:
+        response = completion_cache.get(user_id, payload)
+        if response is not None:
+            return response, True
+
+    start = time()
+    response = await openai_request_async("completions", payload)
+    if cache and completion_cache:
+        completion_cache.set(user_id, payload, response, time() - start)
+    return response, False
+
+
+def _read_completion(user_id, response: dict, cached=False) -> tuple[str, str]:
+    "charge user for tokens (if not cached). -> (text, finish_reason)"
     finish_reason = response["choices"][0]["finish_reason"]
     text = response["choices"][0]["text"].strip().replace('"', "'")
     total_tokens = response["usage"]["total_tokens"]
-    crud.edit_user(user_id, {"tokens": -total_tokens})
-    logger.info(f"TOTAL_TOKENS: {total_tokens}")
-    if finish_reason == "stop":
-        return text
+    if not cached:
+        charge(user_id, total_tokens, response.get("model", ""))
+    logger.info(f"TOTAL_TOKENS: {total_tokens}{' (cached)' if cached else ''}")
+    return text, finish_reason
+
+
+def seam(text: str, segment: str, window: int) -> int:
+    """length of the longest prefix of segment repeated at the end of text
+    (within window chars). KMP prefix function, O(window)"""
+    s = segment[:window] + "\0" + text[-window:]
+    pi = [0] * len(s)
+    for i in range(1, len(s)):
+        k = pi[i - 1]
+        while k and s[i] != s[k]:
+            k = pi[k - 1]
+        if s[i] == s[k]:
+            k += 1
+        pi[i] = k
+    return pi[-1]
+
+
+@dataclass
+class Completion:
+    "one logical completion: all continuation segments"
+
+    text: str = ""
+    finish_reason: str = ""
+    segments: int = 0
+    cached: int = 0  # segments from cache
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
+    latency: float = 0.0  # sec, sum of requests
+
+
+class Continuation:
+    """iterative continuation while finish_reason != 'stop'.\n
+    continue prompt: last CONTINUE_OVERLAP chars of text. repeated seam is cut"""
+
+    min_seam = 8  # shorter repeats are taken as coincidence
+
+    def __init__(self, user_id, prompt, tokens) -> None:
+        self.user_id = user_id
+        self.payload = _completion_payload(prompt, tokens)
+        self.tokens = self.payload["max_tokens"]
+        self.result = Completion()
+
+    def feed(self, response: dict, cached: bool, latency: float) -> dict | None:
+        "add response segment. -> payload of next segment or None if done"
+        text, finish_reason = _read_completion(self.user_id, response, cached)
+        usage = response["usage"]
+        res = self.result
+        res.segments += 1
+        res.cached += cached
+        res.prompt_tokens += usage.get("prompt_tokens", 0)
+        res.completion_tokens += usage.get("completion_tokens", 0)
+        res.total_tokens += usage["total_tokens"]
+        res.latency += latency
+        res.finish_reason = finish_reason
+        if res.text:
+            cut = seam(res.text, text, CONTINUE_OVERLAP)
+            if cut >= self.min_seam:
+                logger.debug(f"SEAM: {cut} chars")
+                res.text += text[cut:]
+            elif text:
+                res.text += " " + text
+        else:
+            res.text = text
+
+        if finish_reason == "stop":
+            return
+
+        if not text:
+            raise Exception(f"Generation interrupt. Finish reason: {finish_reason}")
+
+        if res.segments > CONTINUE_MAX:
+            logger.warning(f"CONTINUE_MAX={CONTINUE_MAX} reached: {finish_reason}")
+            return
 
-    if text:
         prompt_continue = (
-            text[len(text) // 2 :] + "...\n\ncontinue where you left off"
+            res.text[-CONTINUE_OVERLAP:] + "...\n\ncontinue where you left off"
         )  # "keep going" | "go on" | "continue where you left off"
-        text_continue = create_openai_completion(
-            user_id, prompt_continue, tokens, lvl=lvl + 1
+        return _completion_payload(prompt_continue, self.tokens)
+
+    def summary(self) -> str:
+        res = self.result
+        return (
+            f"COMPLETION: segments {res.segments} (cached {res.cached}), "
+            f"tokens {res.total_tokens}, latency {res.latency:.2f} sec"
         )
-        return text + " " + text_continue
 
-    raise Exception(f"Generation interrupt. Finish reason: {finish_reason}")
 
+def complete(user_id, prompt, tokens, cache=True) -> Completion:
+    "send prompt to openai, continue until finish_reason == 'stop'"
+    engine = Continuation(user_id, prompt, tokens)
+    payload = engine.payload
+    while payload:
+        start = time()
+        response, cached = _request_completion(user_id, payload, cache)
+        payload = engine.feed(response, cached, time() - start)
+    logger.info(engine.summary())
+    return engine.result
+
+
+async def complete_async(user_id, prompt, tokens, cache=True) -> Completion:
+    "same as complete() on the event loop's connection pool"
+    engine = Continuation(user_id, prompt, tokens)
+    payload = engine.payload
+    while payload:
+        start = time()
+        response, cached = await _request_completion_async(user_id, payload, cache)
+        payload = engine.feed(response, cached, time() - start)  # one db session
+    logger.info(engine.summary())
+    return engine.result
+
+
+def create_openai_completion(user_id, prompt, tokens, cache=True) -> str:
+    """
+    send prompt to openai. return openai response text. see complete()\n
+    cache=False - bypass completion cache\n
+    $0.0020 / 1K tokens\n
+    gpt-3.5-turbo-1106" is the flagship model of this family, supports a 16K context window and is optimized for dialog.\n
+    gpt-3.5-turbo-instruct" is an Instruct model and only supports a 4K context window.\n
+    https://openai.com/pricing\n
+    """
+    # raise Exception("Stop before openai_request")
+    return complete(user_id, prompt, tokens, cache).text
+
+
+async def create_openai_completion_async(user_id, prompt, tokens, cache=True) -> str:
+    "same as create_openai_completion() on the event loop's connection pool"
+    return (await complete_async(user_id, prompt, tokens, cache)).text
+
+
+def _stream_choices(payload: dict) -> Iterator[dict]:
+    """one streamed request. yield choices {'text', 'finish_reason'}.\n
+    retried by retry_policy until the first choice arrives"""
+    for attempt in range(retry_policy.attempts):
+        started = False
+        try:
+            rate_limiter.acquire(*_rate_key("completions", payload))
+            with get_client().stream(
+                "POST", "completions", json={**payload, "stream": True}
+            ) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line.startswith("data: "):
+                        continue
+
+                    if line == "data: [DONE]":
+                        break
 
-async def create_openai_completion_async(user_id, template, tokens):
-    return await asyncio.to_thread(create_openai_completion, user_id, template, tokens)
+                    started = True
+                    yield json.loads(line[6:])["choices"][0]
+            return
+
+        except Exception as e:
+            if started:  # chunks are sent to client already
+                raise
+            sleep(retry_policy.check(attempt, e))
+
+
+def _continue_text(text: str, segment: str) -> str:
+    "continuation segment to append to text, repeated seam cut (as Continuation)"
+    cut = seam(text, segment, CONTINUE_OVERLAP)
+    if cut >= Continuation.min_seam:
+        return segment[cut:]
+    return " " + segment if segment else ""
+
+
+def stream_openai_completion(user_id, prompt, tokens) -> Iterator[str]:
+    """send prompt to openai with stream=True. yield text chunks as they arrive.\n
+    finish_reason 'length': continuation like complete(), head of continuation is
+    held until its seam with text is cut. no cache. usage is counted by tokenizer"""
+    payload = _completion_payload(prompt, tokens)
+    max_tokens = payload["max_tokens"]
+    text, usage, finish_reason = "", [], None
+    try:
+        for segment in range(CONTINUE_MAX + 1):
+            received, held = [], segment > 0
+            usage.append((payload["prompt"], received))
+            finish_reason = None
+            for choice in _stream_choices(payload):
+                finish_reason = choice.get("finish_reason") or finish_reason
+                chunk = choice["text"].replace('"', "'")
+                if not chunk:
+                    continue
+
+                received.append(chunk)
+                if held:
+                    head = "".join(received)
+                    if len(head) < CONTINUE_OVERLAP:
+                        continue
+                    chunk, held = _continue_text(text, head), False
+                elif not text:
+                    chunk = chunk.lstrip()
+                if chunk:
+                    text += chunk
+                    yield chunk
+
+            if held and received:  # continuation shorter than overlap
+                chunk = _continue_text(text, "".join(received))
+                if chunk:
+                    text += chunk
+                    yield chunk
+            if finish_reason != "length":
+                break
+
+            if not received:
+                raise Exception(f"Generation interrupt. Finish reason: {finish_reason}")
+
+            prompt_continue = (
+                text[-CONTINUE_OVERLAP:] + "...\n\ncontinue where you left off"
+            )
+            payload = _completion_payload(prompt_continue, max_tokens)
+        else:
+            logger.warning(f"CONTINUE_MAX={CONTINUE_MAX} reached: {finish_reason}")
+
+    finally:  # client may disconnect: charge for what was received
+        total_tokens = sum(
+            count_token(p) + count_token("".join(r)) for p, r in usage if r
+        )
+        if total_tokens:
+            charge(user_id, total_tokens, payload["model"])
+            logger.info(
+                f"TOTAL_TOKENS: {total_tokens} "
+                f"(stream: {finish_reason}, segments {len(usage)})"
+            )
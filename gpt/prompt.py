@@ -1,15 +1,20 @@
 import inspect
 import json
 import re
+from copy import copy
+from dataclasses import dataclass as stddataclass
+from functools import lru_cache
+from types import MappingProxyType
 
 # from dataclasses import field  # fields, InitVar, dataclass
-from typing import Literal
+from typing import Literal, Mapping
 
 from pydantic.dataclasses import Field, dataclass
 
 import gpt.pr_str as pr
 from crud import crud
 from settings import DEBUG, TOPIC
+from utils import check_user
 
 
 @dataclass
@@ -25,23 +30,36 @@ class Params:
     pro: bool = False
     html: bool = False
     seo: bool = False
+    cache: bool = True  # False - bypass completion cache
+    compact_toc: bool = False  # longread chapters: full text of neighbours only
+    batch: int = 1  # scheduled shortread: topics per run
 
     @classmethod
     def from_dict(cls, dict_kwargs):
         "create instance from dict. ignore extra arguments passed to a dataclass"
         return cls(
-            **{
-                k: v
-                for k, v in dict_kwargs.items()
-                if k in inspect.signature(cls).parameters
-            }
+            **{k: v for k, v in dict_kwargs.items() if k in cls.__dataclass_fields__}
         )
 
+    @classmethod
+    def parse(cls, params: str | None) -> "Params":
+        "params json -> Params. validated once per distinct json, copy per call"
+        return copy(_parse_params(params or "{}"))
+
     def __post_init__(self):
         self.tokens = int(self.tokens)
+        self.batch = int(self.batch)
         self.language = self.language.capitalize()
 
 
+@lru_cache(maxsize=256)
+def _parse_params(params: str) -> Params:
+    return Params.from_dict(json.loads(params))
+
+
+_mods_cache: tuple[int, "Mods"] | None = None  # (p_mod version, Mods)
+
+
 @dataclass
 class Mods:
     "Mods to construct prompt"
@@ -80,8 +98,24 @@ class Mods:
     )
 
     @classmethod
-    def get_mods_from_db(cls):
-        "get mods from db and create Mods instance"
+    def get_mods_from_db(cls, version: int = None):
+        """get mods from db and create Mods instance.\n
+        process cache: full reload only if p_mod version changed. read only.
+        version: known p_mod version, skips version query"""
+        global _mods_cache
+        if version is None:
+            version = crud.get_prompt_mod_version()
+        cached = _mods_cache
+        if cached and cached[0] == version:
+            return cached[1]
+
+        mods = cls.load_mods()
+        _mods_cache = version, mods  # one tuple: atomic swap between threads
+        return mods
+
+    @classmethod
+    def load_mods(cls):
+        "all p_mod rows -> Mods instance"
         mods = {}
         dbmods: list[dict] = crud.get_prompt_mod_all()
         mods: dict = {
@@ -106,19 +140,23 @@ class Prompt:
     params: str | Params = None
 
     mods: Mods = None
+    pfields: list[str] | None = None  # prompt field names, None - from db
     topic: str = ""
+    topic_pos: int | None = None  # topic_queue pos of popped topic
     text: str = "Text text text text\ntext text text text."
     toc: str = "1. One\n2. Two\n3. Three\n4. Four"
 
     def __post_init__(self):
-        self.params = Params.from_dict(json.loads(self.params or "{}"))
-        self.mods = Mods.get_mods_from_db()
+        if not isinstance(self.params, Params):
+            self.params = Params.parse(self.params)
+        if self.mods is None:
+            self.mods = Mods.get_mods_from_db()
 
-    def write_topic_list(self):
-        "write topic_list to db"
-        crud.edit_prompt(
-            self.user_id, self.id, {"topic_list": "; ".join(self.topic_list)}
-        )
+    def release_topic(self):
+        "failed run: popped topic back to its place in topic queue"
+        if self.topic_pos is not None:
+            crud.push_topics(self.id, [{"topic": self.topic, "pos": self.topic_pos}])
+            self.topic_pos = None
 
     def get_toc_list(self, *, numbered=True) -> list[str]:
         "get TOC as list[str, str ...]"
@@ -134,3 +172,40 @@ class Prompt:
             if toc_list:
                 toc_list[-1] += "\n" + line
         return toc_list[:3] if DEBUG else toc_list
+
+
+@stddataclass(frozen=True)
+class Context:
+    "immutable inputs of a generation run: Context.load() - one db query"
+
+    user: Mapping
+    prompt: Mapping
+    pfields: tuple[str, ...]
+    params: Params
+    mods: Mods
+
+    @classmethod
+    def load(cls, user_id, prompt_id) -> "Context":
+        "user, prompt, prompt fields, mods (cached by version) at once"
+        res = crud.get_prompt_context(user_id, prompt_id)
+        return cls(
+            user=MappingProxyType(res["user"]),
+            prompt=MappingProxyType(res["prompt"]),
+            pfields=tuple(res["pfields"]),
+            params=Params.parse(res["prompt"]["params"]),
+            mods=Mods.get_mods_from_db(res["mods_version"]),
+        )
+
+    def invalid_user(self) -> dict | None:
+        return check_user(self.user)
+
+    def make_prompt(self) -> Prompt:
+        "mutable Prompt for one run, without db queries"
+        return Prompt(
+            **self.prompt
+            | {
+                "params": copy(self.params),
+                "mods": self.mods,
+                "pfields": [*self.pfields],
+            }
+        )
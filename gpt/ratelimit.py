@@ -0,0 +1,77 @@
+import asyncio
+import os
+import sqlite3
+from time import sleep, time
+
+from loguru import logger
+
+logger = logger.bind(name="gpt")
+
+
+class RateLimiter:
+    """token bucket per key (model | 'images') for requests and tokens per minute.\n
+    buckets are kept in sqlite file shared by all processes (web, cron, dalle)\n
+    limits: {key: (rpm, tpm)}; default: (rpm, tpm) for other keys"""
+
+    def __init__(self, path: str, limits: dict, default: tuple[int, int]) -> None:
+        self.path = path
+        self.limits = limits
+        self.default = default
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("""CREATE TABLE IF NOT EXISTS bucket (
+                key TEXT PRIMARY KEY, requests REAL, tokens REAL, updated REAL)""")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def reserve(self, key: str, tokens: int) -> float:
+        "take 1 request and tokens from buckets. -> 0 or seconds to wait"
+        rpm, tpm = self.limits.get(key, self.default)
+        tokens = min(tokens, tpm)  # request bigger than bucket waits for full bucket
+        now = time()
+        con = self._connect()
+        try:
+            con.execute("BEGIN IMMEDIATE")  # lock between processes
+            row = con.execute(
+                "SELECT requests, tokens, updated FROM bucket WHERE key = ?", (key,)
+            ).fetchone()
+            req_level, tok_level, updated = row or (rpm, tpm, now)
+            elapsed = max(now - updated, 0)
+            req_level = min(rpm, req_level + elapsed * rpm / 60)
+            tok_level = min(tpm, tok_level + elapsed * tpm / 60)
+            wait = max(
+                (1 - req_level) * 60 / rpm,
+                (tokens - tok_level) * 60 / tpm,
+                0,
+            )
+            if not wait:
+                req_level -= 1
+                tok_level -= tokens
+            con.execute(
+                "INSERT OR REPLACE INTO bucket VALUES (?, ?, ?, ?)",
+                (key, req_level, tok_level, now),
+            )
+            con.execute("COMMIT")
+            return wait
+
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+
+        finally:
+            con.close()
+
+    def acquire(self, key: str, tokens: int = 0):
+        "block until request fits into rpm/tpm limits"
+        while wait := self.reserve(key, tokens):
+            logger.info(f"RATE LIMIT {key}: wait {wait:.2f} sec")
+            sleep(wait)
+
+    async def acquire_async(self, key: str, tokens: int = 0):
+        """wait (asyncio.sleep) until request fits into rpm/tpm limits.
+        reserve() on a thread: locked sqlite does not stall the event loop"""
+        while wait := await asyncio.to_thread(self.reserve, key, tokens):
+            logger.info(f"RATE LIMIT {key}: wait {wait:.2f} sec")
+            await asyncio.sleep(wait)
@@ -0,0 +1,18 @@
+from crud import crud
+from gpt.constructor import LongreadTemplateConstructor
+from gpt.creator import Longread
+from gpt.prompt import Context
+
+
+def gpt_resume(user_id, run_id) -> dict:
+    "finish longread run: regenerate missing and failed chapters only"
+    run = crud.get_gen_run(user_id, run_id)
+    if run["state"] == "done":  # chapters are gone, content is complete
+        return {"message": "success", "content_id": run["content_id"], "resumed": []}
+
+    ctx = Context.load(user_id, run["prompt_id"])
+    invalid = ctx.invalid_user()
+    if invalid:
+        return {"message": "fail", "user": invalid}
+
+    return Longread(LongreadTemplateConstructor(ctx.make_prompt())).resume(run)
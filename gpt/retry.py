@@ -0,0 +1,85 @@
+import asyncio
+import random
+from email.utils import parsedate_to_datetime
+from time import sleep, time
+
+import httpx
+from loguru import logger
+
+logger = logger.bind(name="gpt")
+
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+def retry_after(e: Exception) -> float | None:
+    "seconds from Retry-After header (seconds | http-date) or None"
+    if not isinstance(e, httpx.HTTPStatusError):
+        return
+
+    value = e.response.headers.get("retry-after")
+    if value is None:
+        return
+
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time(), 0)
+    except (TypeError, ValueError):
+        return
+
+
+def retryable(e: Exception) -> bool:
+    "transport errors, timeouts, 429 and 5xx are retryable; the rest is fatal"
+    if isinstance(e, httpx.HTTPStatusError):
+        if e.response.status_code == 429 and "insufficient_quota" in e.response.text:
+            return False  # billing problem, waiting does not help
+
+        return e.response.status_code in RETRY_STATUS
+
+    return isinstance(e, httpx.TransportError)
+
+
+class RetryPolicy:
+    """retry retryable errors with exponential backoff and full jitter.\n
+    Retry-After header has priority over backoff"""
+
+    def __init__(self, attempts: int = 3, base: float = 1, cap: float = 60) -> None:
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt: int, e: Exception) -> float:
+        "sec to wait before next attempt (attempt: 0, 1, ...)"
+        wait = retry_after(e)
+        if wait is None:
+            wait = random.uniform(0, min(self.cap, self.base * 2**attempt))
+        return wait
+
+    def check(self, attempt: int, e: Exception) -> float:
+        "raise if fatal or last attempt. -> delay"
+        if not retryable(e) or attempt + 1 >= self.attempts:
+            raise e
+
+        wait = self.delay(attempt, e)
+        logger.warning(
+            f"RETRY {attempt + 1}/{self.attempts - 1} in {wait:.2f} sec: {e}"
+        )
+        return wait
+
+    def call(self, func, *args, **kwargs):
+        "func(*args, **kwargs) with retries"
+        for attempt in range(self.attempts):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                sleep(self.check(attempt, e))
+
+    async def call_async(self, func, *args, **kwargs):
+        "await func(*args, **kwargs) with retries. asyncio.sleep between attempts"
+        for attempt in range(self.attempts):
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                await asyncio.sleep(self.check(attempt, e))
@@ -0,0 +1,23 @@
+from gpt.constructor import (
+    LongreadTemplateConstructor,
+    ShortreadTemplateConstructor,
+    TopicListTemplateConstructor,
+)
+from gpt.creator import Longread, Shortread, TopicList
+from gpt.prompt import Context
+
+
+def gpt_run(user_id, prompt_id, topic=None, ctx: Context = None) -> dict | list:
+    """gpt_gen() on Context.load(): user, prompt, fields and mods in one query.
+    topic: topic list by topic. ctx: already loaded by caller"""
+    ctx = ctx or Context.load(user_id, prompt_id)
+    invalid = ctx.invalid_user()
+    if invalid:
+        return {"message": "fail", "user": invalid}
+
+    pt = ctx.make_prompt()
+    if topic:
+        return TopicList(TopicListTemplateConstructor(pt), topic).create()
+    if pt.params.longread:
+        return Longread(LongreadTemplateConstructor(pt)).create()
+    return Shortread(ShortreadTemplateConstructor(pt)).create()
@@ -0,0 +1,36 @@
+import json
+from typing import Iterator
+
+from loguru import logger
+
+from gpt.constructor import LongreadTemplateConstructor, ShortreadTemplateConstructor
+from gpt.creator import Longread, Shortread
+from gpt.prompt import Context
+
+logger = logger.bind(name="gpt")
+
+
+def gpt_stream(user_id, prompt_id) -> Iterator[tuple[str, dict | str]]:
+    "streaming gpt_gen(). yield (event, data): content | text | done"
+    ctx = Context.load(user_id, prompt_id)
+    invalid = ctx.invalid_user()
+    if invalid:
+        yield "done", {"message": "fail", "user": invalid}
+        return
+
+    pt = ctx.make_prompt()
+    if pt.params.longread:
+        yield from Longread(LongreadTemplateConstructor(pt)).stream()
+    else:
+        yield from Shortread(ShortreadTemplateConstructor(pt)).stream()
+
+
+def sse(events: Iterator[tuple[str, dict | str]]) -> Iterator[str]:
+    "format (event, data) as server-sent events. exception -> 'error' event"
+    try:
+        for event, data in events:
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    except Exception as e:
+        logger.exception(e)
+        yield f"event: error\ndata: {json.dumps(str(e))}\n\n"
@@ -1,22 +1,26 @@
+# one shot for system cron. resident alternative: gpt_scheduler.py
+# crontab every settings.CRON_INTERVAL minutes: runs due since the last call
 from datetime import datetime
 
 from loguru import logger
 
-from app import app
-from crud import crud
-from gpt import gpt_gen
+from gpt_scheduler import tick
+from gpt.dispatch import Dispatcher
+from settings import (
+    CRON_INTERVAL,
+    SCHED_CATCHUP,
+    SCHED_PER_USER,
+    SCHED_TIMEOUT,
+    SCHED_WORKERS,
+)
 
 if __name__ == "__main__":
     logger = logger.bind(name="gpt")
 
     NOW = datetime.now()
-    WEEKDAY, H, M = NOW.weekday() + 1, NOW.hour, NOW.minute
-
-    with app.app_context():
-        events = crud.get_event_all(WEEKDAY, H, M)
-        # events = [{'user_id': int, 'prompt_id': int}, {}...]
-        for event in events:
-            logger.info(
-                f"=======CRON=======\nWeekDay H:M >> {WEEKDAY} {H}:{M:02} EVENT >> {event}"
-            )
-            gpt_gen(event.get("user_id"), event.get("prompt_id"))
+    # events run concurrently: SCHED_WORKERS in total, SCHED_PER_USER per user
+    dispatcher = Dispatcher(SCHED_WORKERS, SCHED_PER_USER, "cron", SCHED_TIMEOUT)
+    tick(NOW, dispatcher, max(CRON_INTERVAL, SCHED_CATCHUP))
+    dispatcher.join()
+    dispatcher.shutdown()
+    logger.info(f"=======CRON======= {NOW:%H:%M} {dispatcher.summary()}")
@@ -0,0 +1,83 @@
+"""resident scheduler: python gpt_scheduler.py\n
+replaces per-minute gpt_cron.py: app context, db pool and tokenizer stay warm.
+ticks at the start of every minute, due timetable events go to a dispatcher.
+SIGTERM: stop ticking, finish running generations
+"""
+
+import signal
+from datetime import datetime
+from threading import Event
+from time import time
+
+from loguru import logger
+
+from app import app
+from crud import crud
+from gpt.batch import gpt_batch
+from gpt.dispatch import Dispatcher
+from gpt.openai import count_token
+from gpt.prompt import Context
+from gpt.run import gpt_run
+from settings import (
+    SCHED_CATCHUP,
+    SCHED_DEADLINE,
+    SCHED_PER_USER,
+    SCHED_TIMEOUT,
+    SCHED_WORKERS,
+)
+
+logger = logger.bind(name="gpt")
+
+stop = Event()
+
+
+def run_event(user_id, prompt_id):
+    "gpt_run (gpt_batch if params.batch > 1) on one Context.load() in app context"
+    with app.app_context():
+        ctx = Context.load(user_id, prompt_id)
+        if ctx.params.batch > 1 and not ctx.params.longread:
+            gpt_batch(user_id, prompt_id, ctx.params.batch, ctx=ctx)
+        else:
+            gpt_run(user_id, prompt_id, ctx=ctx)
+
+
+def tick(now: datetime, dispatcher: Dispatcher, catchup: int = SCHED_CATCHUP):
+    """dispatch timetables due at now, missed ones up to catchup minutes.
+    not started in SCHED_DEADLINE sec -> expired"""
+    with app.app_context():
+        events = crud.claim_due_timetables(int(now.timestamp()), catchup * 60)
+    deadline = time() + SCHED_DEADLINE
+    for event in events:
+        logger.info(f"=======SCHEDULER=======\n{now:%a %H:%M} EVENT >> {event}")
+        user_id, prompt_id = event.get("user_id"), event.get("prompt_id")
+        dispatcher.submit(
+            user_id,
+            (user_id, prompt_id),
+            lambda u=user_id, p=prompt_id: run_event(u, p),
+            deadline,
+        )
+
+
+def main():
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    count_token("warm up tokenizer")
+
+    dispatcher = Dispatcher(SCHED_WORKERS, SCHED_PER_USER, "sched", SCHED_TIMEOUT)
+    logger.info(f"SCHEDULER: started, {SCHED_WORKERS} workers")
+    while not stop.wait(60 - time() % 60):  # sleep till the next minute
+        now = datetime.now()
+        try:  # late or skipped tick: due timetables are still due
+            tick(now, dispatcher)
+        except Exception as e:
+            logger.exception(e)
+        if now.minute % 10 == 0:
+            logger.info(f"SCHEDULER: {dispatcher.summary()}")
+
+    logger.info("SCHEDULER: stopping, wait for running generations")
+    dispatcher.shutdown()
+    logger.info(f"SCHEDULER: stopped {dispatcher.summary()}")
+
+
+if __name__ == "__main__":
+    main()
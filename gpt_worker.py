@@ -0,0 +1,96 @@
+"""job queue worker pool: python gpt_worker.py [workers]\n
+executes jobs queued by api (settings.JOB_QUEUE=true). SIGTERM: finish running jobs.
+running jobs get heartbeat; jobs of dead workers are requeued by any pool
+"""
+
+import os
+import signal
+import socket
+import sys
+from threading import Event, Thread
+
+from loguru import logger
+
+from app import app
+from crud import crud
+from dalle_gen import dalle_gen
+from gpt.batch import gpt_batch
+from gpt.resume import gpt_resume
+from gpt.run import gpt_run
+from settings import JOB_ATTEMPTS, JOB_HEARTBEAT, JOB_POLL, JOB_STALE, JOB_WORKERS
+
+logger = logger.bind(name="gpt")
+
+stop = Event()
+busy = set()  # workers running a job, for heartbeat
+
+
+def run_job(job: dict):
+    "execute job. -> result"
+    user_id, args = job["user_id"], job["args"]
+    if job["kind"] == "gen":
+        return gpt_run(user_id, args["prompt_id"])
+    if job["kind"] == "topic":
+        return gpt_run(user_id, args["prompt_id"], topic=args["topic"])
+    if job["kind"] == "batch":
+        return gpt_batch(user_id, args["prompt_id"], args["n"])
+    if job["kind"] == "resume":
+        return gpt_resume(user_id, args["run_id"])
+    if job["kind"] == "dalle":
+        return dalle_gen(user_id, args["content_id"], args["iprompt_id"])
+    raise ValueError(f"unknown job kind: {job['kind']}")
+
+
+def work(name: str):
+    "claim and execute jobs until stop"
+    while not stop.is_set():
+        with app.app_context():
+            try:
+                job = crud.claim_job(name)
+            except Exception:
+                job = None  # logged by crud, db may be locked: try later
+            if not job:
+                stop.wait(JOB_POLL)
+                continue
+
+            logger.info(f"JOB {job['id']} {job['kind']} {job['args']} >> {name}")
+            busy.add(name)
+            try:
+                done = crud.finish_job(job["id"], name, result=run_job(job))
+            except Exception as e:
+                logger.exception(e)
+                done = crud.finish_job(job["id"], name, error=str(e) or repr(e))
+            finally:
+                busy.discard(name)
+            if not done:
+                logger.warning(
+                    f"JOB {job['id']}: taken by other worker, result dropped"
+                )
+
+
+if __name__ == "__main__":
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else JOB_WORKERS
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    prefix = f"{socket.gethostname()}:{os.getpid()}"
+    threads = [Thread(target=work, args=(f"{prefix}:{i}",)) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    logger.info(f"WORKER {prefix}: {workers} threads")
+
+    while True:
+        try:
+            with app.app_context():
+                crud.beat_jobs(list(busy))
+                res = crud.requeue_jobs(JOB_STALE, JOB_ATTEMPTS)
+            if any(res.values()):
+                logger.warning(f"WORKER: stale jobs {res}")
+        except Exception:
+            pass  # logged by crud, db may be locked: try later
+        if stop.wait(JOB_HEARTBEAT):
+            break
+
+    for thread in threads:
+        thread.join()
+    logger.info(f"WORKER {prefix}: stopped")
@@ -1,3 +1,4 @@
+import json
 from random import randint
 from time import time
 
@@ -37,6 +38,27 @@ class User(db.Model):
         }
 
 
+class TokenLedger(db.Model):
+    "token movements: + credit (trial, admin, opening), - usage (model name)"
+
+    __tablename__ = "token_ledger"
+    _protected = ["id", "user_id"]
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("user.id", ondelete="CASCADE"),
+        nullable=True,
+        index=True,
+    )
+    tokens = db.Column(db.Integer, default=0)
+    note = db.Column(db.String(100))
+    date = db.Column(db.BigInteger, default=lambda: int(time()))
+
+    def as_dict(self):
+        return {i.name: getattr(self, i.name) for i in self.__table__.columns}
+
+
 class Prompt(db.Model):
     __tablename__ = "prompt"
     _protected = ["id", "user_id"]
@@ -84,6 +106,25 @@ class PField(db.Model):
         return {i.name: getattr(self, i.name) for i in self.__table__.columns}
 
 
+class TopicQueue(db.Model):
+    "topics of prompt, popped by pos: lowest (normal) | highest (reverse) | random"
+
+    __tablename__ = "topic_queue"
+    __table_args__ = (db.Index("ix_topic_queue_prompt_pos", "prompt_id", "pos"),)
+    _protected = ["id", "prompt_id"]
+
+    id = db.Column(db.Integer, primary_key=True)
+    prompt_id = db.Column(
+        db.Integer, db.ForeignKey("prompt.id", ondelete="CASCADE"), nullable=True
+    )
+    pos = db.Column(db.Integer)
+    topic = db.Column(db.Text)
+    claimed = db.Column(db.BigInteger)  # batch claim time, null: free
+
+    def as_dict(self):
+        return {i.name: getattr(self, i.name) for i in self.__table__.columns}
+
+
 class PFList(db.Model):
     __tablename__ = "pf_list"
     name = db.Column(db.String(500), primary_key=True)
@@ -116,6 +157,7 @@ class Timetable(db.Model):
     timezone = db.Column(
         db.Integer, db.CheckConstraint('"timezone" BETWEEN -12 AND 12'), default=0
     )
+    next_run_at = db.Column(db.BigInteger, index=True)  # UTC timestamp
 
     def as_dict(self):
         return {i.name: getattr(self, i.name) for i in self.__table__.columns}
@@ -142,6 +184,24 @@ class Content(db.Model):
         return {i.name: getattr(self, i.name) for i in self.__table__.columns}
 
 
+class RowCount(db.Model):
+    """maintained row counts, written with the rows they count.
+    kind 'content': by prompt_id + post; kind 'prompt': prompt_id 0, post ''"""
+
+    __tablename__ = "row_count"
+
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), primary_key=True
+    )
+    kind = db.Column(db.String(20), primary_key=True)
+    prompt_id = db.Column(db.Integer, primary_key=True, default=0)
+    post = db.Column(db.String(50), primary_key=True, default="")
+    value = db.Column(db.Integer, default=0)
+
+    def as_dict(self):
+        return {i.name: getattr(self, i.name) for i in self.__table__.columns}
+
+
 class CField(db.Model):
     __tablename__ = "c_field"
     _protected = ["id", "content_id"]
@@ -160,6 +220,60 @@ class CField(db.Model):
         return {i.name: getattr(self, i.name) for i in self.__table__.columns}
 
 
+class GenRun(db.Model):
+    "longread generation run: TOC checkpoint. state: running | done | partial"
+
+    __tablename__ = "gen_run"
+    _protected = ["id", "user_id", "prompt_id"]
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("user.id", ondelete="CASCADE"),
+        nullable=True,
+        index=True,
+    )
+    prompt_id = db.Column(
+        db.Integer,
+        db.ForeignKey("prompt.id", ondelete="CASCADE"),
+        nullable=True,
+        index=True,
+    )
+    content_id = db.Column(
+        db.Integer, db.ForeignKey("content.id", ondelete="SET NULL"), nullable=True
+    )
+    topic = db.Column(db.Text)
+    toc = db.Column(db.Text)
+    state = db.Column(db.String(20), default="running")
+    date = db.Column(db.BigInteger, default=lambda: int(time()))
+
+    def as_dict(self):
+        return {i.name: getattr(self, i.name) for i in self.__table__.columns}
+
+
+class GenChapter(db.Model):
+    "chapter checkpoint of gen_run. state: done | failed"
+
+    __tablename__ = "gen_chapter"
+    _protected = ["id", "run_id"]
+
+    id = db.Column(db.Integer, primary_key=True)
+    run_id = db.Column(
+        db.Integer,
+        db.ForeignKey("gen_run.id", ondelete="CASCADE"),
+        nullable=True,
+        index=True,
+    )
+    idx = db.Column(db.Integer)  # position in TOC
+    title = db.Column(db.Text)
+    text = db.Column(db.Text)  # title + chapter, as in content
+    state = db.Column(db.String(20))
+    error = db.Column(db.Text)
+
+    def as_dict(self):
+        return {i.name: getattr(self, i.name) for i in self.__table__.columns}
+
+
 class IPrompt(db.Model):
     __tablename__ = "i_prompt"
     _protected = ["id", "user_id"]
@@ -209,6 +323,48 @@ class PMod(db.Model):
         return {i.name: getattr(self, i.name) for i in self.__table__.columns}
 
 
+class PModVersion(db.Model):
+    "one row: p_mod version, +1 on every edit. cache key of gpt.prompt.Mods"
+
+    __tablename__ = "p_mod_version"
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, default=0)
+
+
+class Job(db.Model):
+    "background generation job. state: queued -> running -> done | failed"
+
+    __tablename__ = "job"
+    _protected = ["id", "user_id"]
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("user.id", ondelete="CASCADE"),
+        nullable=True,
+        index=True,
+    )
+    kind = db.Column(db.String(20))  # gen | topic | dalle
+    args = db.Column(db.Text)  # json
+    state = db.Column(db.String(20), default="queued", index=True)
+    result = db.Column(db.Text)  # json
+    error = db.Column(db.Text)
+    worker = db.Column(db.String(100))
+    created = db.Column(db.BigInteger, default=lambda: int(time()))
+    started = db.Column(db.BigInteger)
+    finished = db.Column(db.BigInteger)
+    heartbeat = db.Column(db.BigInteger)  # refreshed by worker while running
+    attempts = db.Column(db.Integer, default=0)  # claims, max settings.JOB_ATTEMPTS
+
+    def as_dict(self):
+        "args, result: json -> python"
+        res = {i.name: getattr(self, i.name) for i in self.__table__.columns}
+        for i in ("args", "result"):
+            res[i] = json.loads(res[i]) if res[i] else None
+        return res
+
+
 # alternative with dataclass:
 
 # from dataclasses import dataclass
@@ -1,3 +1,4 @@
+import json
 import os
 import platform
 
@@ -17,6 +18,53 @@ print('.env >>> DEBUG="%s"' % os.getenv("DEBUG"))
 OPENAI_KEY = os.getenv("OPENAI_API_KEY")
 MODEL_4K = os.getenv("MODEL_4K")
 MODEL_16K = os.getenv("MODEL_16K")
+OPENAI_URL = os.getenv("OPENAI_URL", "https://api.openai.com/v1")
+OPENAI_TIMEOUT = int(os.getenv("OPENAI_TIMEOUT", 600))  # seconds
+OPENAI_POOL = int(os.getenv("OPENAI_POOL", 20))  # keep-alive connections
+TOKENIZER_THREADS = int(os.getenv("TOKENIZER_THREADS", 8))
+CONTINUE_MAX = int(os.getenv("CONTINUE_MAX", 3))  # continuation requests
+CONTINUE_OVERLAP = int(os.getenv("CONTINUE_OVERLAP", 1000))  # chars
+
+# rate limit: token buckets shared by web workers, cron and dalle
+RATELIMIT_PATH = os.getenv("RATELIMIT_PATH", "./dbstorage/ratelimit.db")
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", 3500))  # default requests per minute
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", 90000))  # default tokens per minute
+OPENAI_LIMITS = json.loads(os.getenv("OPENAI_LIMITS", "{}"))  # {model: [rpm, tpm]}
+IMG_RPM = int(os.getenv("IMG_RPM", 5))  # images per minute
+
+# retry: exponential backoff with jitter, Retry-After has priority
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", 3))
+RETRY_BASE = float(os.getenv("RETRY_BASE", 1))  # sec
+RETRY_CAP = float(os.getenv("RETRY_CAP", 60))  # sec
+
+STREAM_FLUSH = float(os.getenv("STREAM_FLUSH", 1))  # sec between partial writes
+
+# completion cache
+GPT_CACHE = os.getenv("GPT_CACHE") == "true"
+GPT_CACHE_PATH = "./dbstorage/gpt_cache.db"
+GPT_CACHE_TTL = 86400 * int(os.getenv("GPT_CACHE_TTL", 7))  # days
+GPT_CACHE_SIZE = 1024**2 * int(os.getenv("GPT_CACHE_SIZE", 200))  # MB
+
+# job queue: endpoints return job id, gpt_worker.py executes jobs
+JOB_QUEUE = os.getenv("JOB_QUEUE") == "true"
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))  # threads in gpt_worker.py
+JOB_POLL = float(os.getenv("JOB_POLL", 1))  # sec between db polls
+JOB_HEARTBEAT = int(os.getenv("JOB_HEARTBEAT", 30))  # running job refresh, sec
+JOB_STALE = int(os.getenv("JOB_STALE", 300))  # no heartbeat -> requeue, sec
+JOB_ATTEMPTS = int(os.getenv("JOB_ATTEMPTS", 3))  # claims, then 'failed'
+
+# batch shortread: topics per run, concurrent articles
+BATCH_MAX = int(os.getenv("BATCH_MAX", 50))
+BATCH_WIDTH = int(os.getenv("BATCH_WIDTH", 5))
+TOPIC_CLAIM = int(os.getenv("TOPIC_CLAIM", 3600))  # claimed topic -> free again, sec
+
+# gpt_scheduler.py
+SCHED_WORKERS = int(os.getenv("SCHED_WORKERS", 4))  # parallel generations
+SCHED_PER_USER = int(os.getenv("SCHED_PER_USER", 2))  # parallel for one user
+SCHED_DEADLINE = int(os.getenv("SCHED_DEADLINE", 600))  # not started -> expired, sec
+SCHED_TIMEOUT = int(os.getenv("SCHED_TIMEOUT", 3600))  # running -> slot freed, sec
+SCHED_CATCHUP = int(os.getenv("SCHED_CATCHUP", 5))  # max missed minutes to run
+CRON_INTERVAL = int(os.getenv("CRON_INTERVAL", 10))  # gpt_cron.py crontab, minutes
 
 # admin
 ADMIN = os.getenv("ADMIN")
@@ -4,7 +4,7 @@ import pytest
 from flask_login import current_user
 from pytest import MonkeyPatch
 
-from crud import DatabaseException
+from crud import DatabaseException, crud
 
 # from pprint import pprint
 
@@ -149,6 +149,29 @@ class TestContent:
         assert len(res_data["list"]) == len_
         assert res_data["list"][0]["title"] == "testtitle" + str(title)
 
+    def test_keyset_pagination(self, auth):
+        auth.login()
+        titles, after_id = [], ""
+        for _ in range(3):
+            res = auth.client.get(prefix + f"/content?limit=4&after_id={after_id}")
+            res_data = json.loads(res.data)
+            assert "count" not in res_data
+            titles += [i["title"] for i in res_data["list"]]
+            after_id = res_data["afterId"]
+        assert titles == [f"testtitle{i}" for i in range(10, 0, -1)]
+        assert after_id is None
+
+        before_id = res_data["beforeId"]
+        res = auth.client.get(
+            prefix + f"/content?limit=4&before_id={before_id}&count=1"
+        )
+        res_data = json.loads(res.data)
+        assert [i["title"] for i in res_data["list"]] == [
+            f"testtitle{i}" for i in range(6, 2, -1)
+        ]
+        assert res_data["count"] == 10 and res_data["totalPage"] == 3
+        assert res_data["beforeId"] and res_data["afterId"]
+
 
 @pytest.mark.skipif('config.getoption("--all") == "false"')
 class TestPrompt:
@@ -251,3 +274,81 @@ def test_del_cascade(auth):
 
     res = auth.client.get(prefix + f"/prompt/{prompt_id}/timetable")
     assert json.loads(res.data) == []
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_job_queue(monkeypatch: MonkeyPatch, auth, app):
+    import gpt_worker
+
+    monkeypatch.setattr("api.api_user.JOB_QUEUE", True)
+    monkeypatch.setattr("gpt_worker.gpt_run", lambda user_id, prompt_id: [prompt_id])
+    auth.login()
+    res = auth.client.post(prefix + "/content/add_by/7")
+    assert res.status_code == 202
+    job = json.loads(res.data)["job"]
+    assert job["state"] == "queued" and job["args"] == {"prompt_id": 7}
+    res = auth.client.get(prefix + f"/job/{job['id']}")  # at once, no long-poll
+    assert res.headers["Retry-After"] == "1"
+
+    with app.app_context():
+        claimed = crud.claim_job("test")
+        assert claimed["id"] == job["id"] and claimed["state"] == "running"
+        assert crud.claim_job("test") is None
+        assert crud.finish_job(claimed["id"], "other", result=[0]) is False
+        crud.finish_job(claimed["id"], "test", result=gpt_worker.run_job(claimed))
+
+    res = auth.client.get(prefix + f"/job/{job['id']}")
+    assert "Retry-After" not in res.headers
+    res = json.loads(res.data)
+    assert res["state"] == "done" and res["result"] == [7]
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+@pytest.mark.parametrize(
+    "view",
+    [
+        "/views/user/prompt",
+        "/views/user/content",
+        "/views/admin/prompt/1",
+        "/views/admin/content/1",
+    ],
+)
+def test_view_query_count(auth, app, view):
+    "list views: same number of queries for 1 and 3 more rows with children"
+    from sqlalchemy import event
+
+    def count_queries() -> int:
+        queries = []
+        listener = lambda *args: queries.append(args[2])  # noqa: E731
+        with app.app_context():
+            engine = crud.db.engine
+        event.listen(engine, "before_cursor_execute", listener)
+        try:
+            assert auth.client.get(view).status_code == 200
+        finally:
+            event.remove(engine, "before_cursor_execute", listener)
+        return len(queries)
+
+    def add_rows(n):
+        with app.app_context():
+            for _ in range(n):
+                prompt_id = crud.add_prompt(1)["id"]
+                crud.add_prompt_field(prompt_id, "title", "")
+                crud.add_timetable(prompt_id, "1", "10", "0", "0")
+                content_id = crud.add_content(1, prompt_id)["id"]
+                crud.add_content_field(content_id, "img", "a.png")
+                rows.append((prompt_id, content_id))
+
+    rows = []
+    auth.login()
+    with auth.client.session_transaction() as session:
+        session["admin_logged"] = 1
+    add_rows(1)
+    queries = count_queries()
+    add_rows(3)
+    assert count_queries() == queries
+
+    with app.app_context():
+        for prompt_id, content_id in rows:
+            crud.del_content(1, content_id)
+            crud.del_prompt(1, prompt_id)
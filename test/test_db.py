@@ -1,6 +1,13 @@
+from time import time
+
 import pytest
+from pytest import MonkeyPatch
+from sqlalchemy import text, update
 
-from crud import crud
+import models as m
+from crud import NEVER, crud, next_run_at
+from gpt.constructor import ShortreadTemplateConstructor
+from gpt.prompt import Context, Mods
 
 
 @pytest.mark.skipif('config.getoption("--all") == "false"')
@@ -23,3 +30,233 @@ class TestPflist:
             crud.del_prompt_field_list(nam)
             res = crud.get_prompt_field_list_all()
             assert {"name": nam, "type": typ} not in res
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_token_ledger(app):
+    with app.app_context():
+        assert crud.reconcile_tokens()["fixed"] == []
+        tokens = crud.get_user(1).tokens
+        crud.add_tokens(1, [(-10, "model"), (-5, "model")])
+        assert crud.get_user(1).tokens == tokens - 15
+
+        crud.db.session.execute(text("UPDATE user SET tokens = 0 WHERE id = 1"))
+        crud.db.session.commit()
+        res = crud.reconcile_tokens()
+        assert res["fixed"] == [{"user_id": 1, "tokens": 0, "ledger": tokens - 15}]
+        assert crud.get_user(1).tokens == tokens - 15
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_token_ledger_charged_before_reconcile(app):
+    "user from before ledger: charged first, reconciled after"
+    with app.app_context():
+        user = m.User(email="old_user", psw="x", tokens=1000)
+        crud.db.session.add(user)
+        crud.db.session.commit()
+        crud.add_tokens(user.id, [(-100, "model")])
+        assert crud.get_user(user.id).tokens == 900
+
+        res = crud.reconcile_tokens()
+        assert res["opened"] == 1 and res["fixed"] == []
+        assert crud.get_user(user.id).tokens == 900
+        opening = m.TokenLedger.query.filter_by(user_id=user.id, note="opening")
+        assert opening.one().tokens == 1000
+        assert crud.reconcile_tokens() == {"opened": 0, "fixed": []}
+        crud.del_user("old_user")
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_mods_cache(monkeypatch: MonkeyPatch, app):
+    with app.app_context():
+        crud.db.session.add(m.PMod(name="style", value="style one {0}"))
+        crud.db.session.commit()
+        crud.edit_prompt_mod("style", "style two {0}")
+        mods = Mods.get_mods_from_db()
+        assert mods.style == "style two {0}"
+
+        loads = []
+        monkeypatch.setattr(Mods, "load_mods", classmethod(lambda cls: loads.append(1)))
+        assert Mods.get_mods_from_db() is mods  # version check only
+        assert loads == []
+
+        monkeypatch.undo()
+        version = crud.get_prompt_mod_version()
+        crud.edit_prompt_mod("style", "")
+        assert crud.get_prompt_mod_version() == version + 1
+        assert Mods.get_mods_from_db().style == Mods().style  # empty -> default
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_prompt_context(app):
+    from sqlalchemy import event
+
+    with app.app_context():
+        prompt_id = crud.add_prompt(1)["id"]
+        crud.add_prompt_field(prompt_id, "title", "")
+        crud.add_prompt_field(prompt_id, "keywords", "")
+        Mods.get_mods_from_db()  # warm cache
+
+        queries = []
+        listener = lambda *args: queries.append(args[2])  # noqa: E731
+        event.listen(crud.db.engine, "before_cursor_execute", listener)
+        try:
+            ctx = Context.load(1, prompt_id)
+            pt = ctx.make_prompt()
+            ShortreadTemplateConstructor(pt).make_shortread_fields()
+        finally:
+            event.remove(crud.db.engine, "before_cursor_execute", listener)
+
+        assert len(queries) == 1
+        assert ctx.pfields == ("title", "keywords") and pt.pfields == list(ctx.pfields)
+        assert pt.params is not ctx.params  # run may change its copy
+        with pytest.raises(TypeError):
+            ctx.prompt["name"] = "x"
+        crud.del_prompt(1, prompt_id)
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_topic_queue(app):
+    with app.app_context():
+        prompt_id = crud.add_prompt(1)["id"]
+        prompt = crud.db.session.get(m.Prompt, prompt_id)
+        prompt.topic_list = "a; b;; c"  # old text: moved to queue on first use
+        crud.db.session.commit()
+
+        assert crud.peek_topics(1, prompt_id) == {"topics": ["a", "b", "c"], "count": 3}
+        assert prompt.topic_list is None
+        assert crud.append_topics(1, prompt_id, ["d", "e"]) == 5
+        assert crud.get_prompt(1, prompt_id)["topic_list"] == "a; b; c; d; e"
+
+        assert crud.pop_topic(prompt_id)["topic"] == "a"
+        assert crud.pop_topic(prompt_id, "reverse")["topic"] == "e"
+        popped = crud.pop_topics(prompt_id, 5)
+        assert [i["topic"] for i in popped] == ["b", "c", "d"]
+        assert crud.pop_topic(prompt_id, "random") is None
+
+        crud.push_topics(prompt_id, popped[1:2])  # back to its place
+        crud.push_topics(prompt_id, popped[:1])
+        assert crud.peek_topics(1, prompt_id)["topics"] == ["b", "c"]
+        assert crud.pop_topic(prompt_id, "random")["topic"] in ("b", "c")
+
+        crud.edit_prompt(1, prompt_id, {"topic_list": "x; y"})
+        assert crud.peek_topics(1, prompt_id, 1, "reverse")["topics"] == ["y"]
+        used = crud.add_content(1, prompt_id, crud.pop_topic(prompt_id)["topic"])
+        res = crud.edit_prompt(1, prompt_id, {"topic_list": "x; y; z"})
+        assert res["topics_skipped"] == ["x"]  # has content: reported, not queued
+        assert crud.peek_topics(1, prompt_id)["topics"] == ["y", "z"]
+        page = crud.get_prompt_all(1, {"limit": 100})["list"]
+        assert [i["topic_count"] for i in page if i["id"] == prompt_id] == [2]
+        crud.del_content(1, used["id"])
+
+        claimed = crud.pop_topics(prompt_id, 2, claim=True)  # batch: y, z
+        assert crud.peek_topics(1, prompt_id)["count"] == 0
+        crud.add_content_batch(1, prompt_id, [], [claimed[0]["id"]], [claimed[1]["id"]])
+        assert crud.peek_topics(1, prompt_id)["topics"] == ["z"]
+        crud.pop_topics(prompt_id, 1, claim=True)
+        crud.db.session.execute(update(m.TopicQueue).values(claimed=1))  # dead worker
+        assert crud.peek_topics(1, prompt_id)["topics"] == ["z"]
+        crud.del_prompt(1, prompt_id)
+        assert not m.TopicQueue.query.filter_by(prompt_id=prompt_id).count()
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_row_count(app):
+    def counted() -> dict:
+        res = crud.db.session.execute(
+            text("SELECT post, count(*) FROM content WHERE user_id=1 GROUP BY post")
+        )
+        c = dict(res.all())
+        c["total"] = sum(c.values())
+        prompts = m.Prompt.query.filter_by(user_id=1).count()
+        return {"prompt_count": prompts, "content_count": c}
+
+    with app.app_context():
+        crud.rebuild_counters()
+        prompt_id = crud.add_prompt(1)["id"]
+        first = crud.add_content(1, prompt_id, post="false")
+        crud.add_content_with_fields(1, prompt_id, "t", "x", "false", {"f": "v"})
+        crud.add_content_batch(1, prompt_id, [{"title": "a", "text": "b"}] * 3)
+        crud.edit_content(1, first["id"], {"post": "true"})
+        assert crud.statistic(1) == counted()
+        assert crud.get_count(1, {"prompt_id": prompt_id}) == {"count": 5}
+
+        crud.del_content(1, first["id"])
+        crud.del_prompt(1, prompt_id)
+        assert crud.statistic(1) == counted()
+        assert crud.rebuild_counters()["fixed"] == []
+
+        crud.db.session.execute(text("UPDATE row_count SET value = value + 7"))
+        crud.db.session.commit()
+        assert crud.statistic(1) != counted()
+        assert crud.rebuild_counters()["fixed"]
+        assert crud.statistic(1) == counted()
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_claim_due_timetables(app):
+    monday = 1704067200  # 2024-01-01 00:00 UTC
+    assert next_run_at("135", 10, 25, monday) == monday + 10 * 3600 + 25 * 60
+    assert next_run_at("7", 0, 0, monday) == monday + 6 * 86400
+    assert next_run_at("1", 0, 0, monday) == monday + 7 * 86400
+    assert next_run_at("0", 0, 0, monday) == NEVER
+
+    with app.app_context():
+        prompt_id = crud.add_prompt(1)["id"]
+        timetable = crud.add_timetable(prompt_id, "1234567", "10", "25", "0")
+        row = crud.db.session.get(m.Timetable, timetable["id"])
+        assert row.next_run_at > time()
+
+        row.next_run_at = monday + 10 * 3600 + 25 * 60
+        crud.db.session.commit()
+        now = row.next_run_at + 90  # tick is late
+        due = crud.claim_due_timetables(now, 300)
+        assert [(i["timetable_id"], i["run_at"]) for i in due] == [
+            (timetable["id"], now - 90)
+        ]
+        assert crud.claim_due_timetables(now, 300) == []  # claimed once
+        crud.db.session.refresh(row)
+        assert row.next_run_at == now - 90 + 86400
+
+        now = row.next_run_at + 3600  # missed by more than catchup
+        assert crud.claim_due_timetables(now, 300) == []
+        crud.db.session.refresh(row)
+        assert row.next_run_at == now - 3600 + 86400
+
+        row.next_run_at = None  # timetable added before next_run_at
+        crud.db.session.commit()
+        assert crud.claim_due_timetables(now - 3600 + 60, 300)
+
+        row.day_utc, row.next_run_at = 0, None  # no weekday: not due, not NULL
+        crud.db.session.commit()
+        assert crud.claim_due_timetables(now, 300) == []
+        crud.db.session.refresh(row)
+        assert row.next_run_at == NEVER
+        crud.del_prompt(1, prompt_id)
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_job_heartbeat(app):
+    def lose_heartbeat(job_id):
+        crud.db.session.execute(
+            text("UPDATE job SET heartbeat = heartbeat - 1000 WHERE id = :id"),
+            {"id": job_id},
+        )
+        crud.db.session.commit()
+
+    with app.app_context():
+        job_id = crud.add_job(1, "gen", {"prompt_id": 0})["id"]
+        assert crud.claim_job("w1")["attempts"] == 1
+        lose_heartbeat(job_id)
+        assert crud.beat_jobs(["w1"]) == 1  # alive worker: not requeued
+        assert crud.requeue_jobs(300, 2) == {"requeued": 0, "failed": 0}
+
+        lose_heartbeat(job_id)
+        assert crud.requeue_jobs(300, 2) == {"requeued": 1, "failed": 0}
+        assert crud.claim_job("w2")["attempts"] == 2
+        assert not crud.finish_job(job_id, "w1", result=1)  # late first run
+
+        lose_heartbeat(job_id)
+        assert crud.requeue_jobs(300, 2) == {"requeued": 0, "failed": 1}
+        job = crud.get_job(1, job_id)
+        assert job["state"] == "failed" and "lost" in job["error"]
@@ -1,16 +1,43 @@
+import asyncio
 import json
+import os
+import sqlite3
+import subprocess
+import sys
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pprint import pprint
+from threading import Event, Lock, Thread
+from time import sleep, time
+from types import SimpleNamespace
 
+import httpx
 import pytest
 from pytest import MonkeyPatch
 
 from crud import crud
-from gpt.prompt import Mods
-from settings import TOPIC
+from gpt.cache import CompletionCache
+from gpt.openai import (
+    close_async_client,
+    complete,
+    count_token,
+    count_tokens,
+    create_openai_completion,
+    create_openai_completion_async,
+    seam,
+    stream_openai_completion,
+)
+from gpt.constructor import LongreadTemplateConstructor
+from gpt.creator import Longread, MarkParser, parse_mark
+from gpt.dispatch import Dispatcher
+from gpt.prompt import Mods, Params, Prompt
+from gpt.ratelimit import RateLimiter
+from gpt.retry import RetryPolicy
+from settings import CONTINUE_OVERLAP, TOPIC
 
 prefix = "/api/user"
 template = "test_template"
-topic_list_str = "cat;dog;duck;humster"
+topic_list_str = "cat;dog;duck;humster;goose"
 topic_list = topic_list_str.split(";")
 topic = "TopicList"
 language = "Russian"
@@ -53,7 +80,7 @@ def test_create_prompt(auth):
 
 @pytest.mark.skipif('config.getoption("--all") == "false"')
 def test_topic_list(monkeypatch: MonkeyPatch, auth):
-    def fake_openai(user_id, prompt, tokens):
+    def fake_openai(user_id, prompt, tokens, **kwargs):
         assert user_id == 1
         assert prompt == (
             mods.topic.replace(TOPIC, topic)
@@ -76,7 +103,7 @@ def test_topic_list(monkeypatch: MonkeyPatch, auth):
 @pytest.mark.skipif('config.getoption("--all") == "false"')
 class TestShortread:
     @staticmethod
-    def fake_openai(user_id, prompt, tokens):
+    def fake_openai(user_id, prompt, tokens, **kwargs):
         assert user_id == 1
         assert tokens == 4000
         return prompt
@@ -153,7 +180,7 @@ def test_longread(monkeypatch: MonkeyPatch, auth):
     toc = "1. First chapter\n2. Second chapter"
     topic_ = topic_list.pop(0)
 
-    def fake_openai(user_id, prompt, tokens):
+    def fake_openai(user_id, prompt, tokens, **kwargs):
         assert user_id == 1
         assert tokens == 4000
         if mods.table[:10] in prompt:
@@ -164,15 +191,16 @@ def test_longread(monkeypatch: MonkeyPatch, auth):
                 + mods.style.format(style)
             )
             return toc
-        assert prompt == (
-            mods.table_fields.format(toc)
-            + mods.opts_base
-            + mods.language.format(language)
-            + mods.style.format(style)
-        )
-        return "##field1 one\n##field2 two"
 
-    async def fake_openai_async(user_id, prompt, tokens):
+    async def fake_openai_async(user_id, prompt, tokens, **kwargs):
+        if prompt.startswith(mods.table_fields.format(toc)):  # with chapters
+            assert prompt == (
+                mods.table_fields.format(toc)
+                + mods.opts_base
+                + mods.language.format(language)
+                + mods.style.format(style)
+            )
+            return "##field1 one\n##field2 two"
         return prompt
 
     monkeypatch.setattr("gpt.creator.create_openai_completion", fake_openai)
@@ -207,4 +235,479 @@ def test_longread(monkeypatch: MonkeyPatch, auth):
     assert data["prompt_id"] == pytest.prompt_id
     assert data["title"] == topic_
 
+    res = auth.client.get(prefix + f"/content/{content_id}/cfield")
+    fields = {i["name"]: i["value"] for i in json.loads(res.data)}
+    assert fields == {"field1": "one", "field2": "two"}
+
     pprint(data)
+
+
+@pytest.fixture
+def openai_stub(monkeypatch: MonkeyPatch):
+    "local openai stand-in. yields list of client ports (one port per connection)"
+    ports = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive
+
+        def do_POST(self):
+            ports.append(self.client_address[1])
+            self.rfile.read(int(self.headers["Content-Length"]))
+            body = json.dumps(
+                {
+                    "choices": [{"text": "stub text", "finish_reason": "stop"}],
+                    "usage": {"total_tokens": 10},
+                }
+            ).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(
+        "gpt.openai.OPENAI_URL", "http://127.0.0.1:%s" % server.server_port
+    )
+    monkeypatch.setattr("gpt.openai._client", None)
+    yield ports
+    server.shutdown()
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_openai_pool(app, openai_stub):
+    async def chapters(n):
+        try:
+            return [
+                await create_openai_completion_async(1, "hi", 100, cache=False)
+                for _ in range(n)
+            ]
+        finally:
+            await close_async_client()
+
+    with app.app_context():
+        assert asyncio.run(chapters(5)) == ["stub text"] * 5
+        assert len(set(openai_stub)) == 1  # 5 requests, 1 connection
+
+        assert create_openai_completion(1, "hi", 100, cache=False) == "stub text"
+        assert create_openai_completion(1, "hi", 100, cache=False) == "stub text"
+        assert len(set(openai_stub[5:])) == 1
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_count_tokens():
+    texts = ["", "one", "1. One\n2. Two\n3. Three", mods.chapter * 10]
+    assert count_tokens(texts) == [count_token(i) for i in texts]
+    assert count_token("<|endoftext|>") > 0  # ordinary text, no special tokens
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_encoding_lazy(tmp_path):
+    code = "import gpt.openai as o; assert o._encoding is None"
+    env = {**os.environ, "TIKTOKEN_CACHE_DIR": str(tmp_path)}  # empty: no download
+    subprocess.run([sys.executable, "-c", code], env=env, check=True, timeout=60)
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_completion_cache(tmp_path):
+    cache = CompletionCache(str(tmp_path / "cache.db"), ttl=60, max_size=300)
+    payload = {"model": "m", "prompt": "p", "temperature": 0.6, "max_tokens": 10}
+    response = {
+        "choices": [{"text": "t", "finish_reason": "stop"}],
+        "usage": {"total_tokens": 7},
+    }
+    assert cache.get(1, payload) is None
+    cache.set(1, payload, response, 1.5)
+    assert cache.get(1, payload) == response
+    assert cache.get(1, {**payload, "max_tokens": 11}) is None
+    assert cache.get(2, payload) is None  # paid by user 1
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 3)
+    assert (stats["tokens_saved"], stats["latency_saved"]) == (7, 1.5)
+
+    for i in range(5):  # size cap evicts least recently used
+        cache.set(1, {**payload, "prompt": str(i)}, response, 1)
+    assert cache.stats()["size"] <= 300
+    assert cache.get(1, {**payload, "prompt": "4"}) == response
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_longread_stream(monkeypatch: MonkeyPatch, app, auth):
+    toc = "1. First chapter\n2. Second chapter"
+    failed_topic, topic_ = topic_list.pop(0), topic_list.pop(0)
+
+    def fail_stream(user_id, prompt, tokens):
+        yield "1. First"
+        raise httpx.ReadTimeout("timeout")
+
+    def fake_stream(user_id, prompt, tokens):
+        text = toc if mods.table[:10] in prompt else "<body>chapter</body>"
+        yield from (text[i : i + 5] for i in range(0, len(text), 5))
+
+    monkeypatch.setattr("gpt.creator.stream_openai_completion", fail_stream)
+    monkeypatch.setattr(
+        "gpt.creator.create_openai_completion", lambda *a, **kw: "##field1 one"
+    )
+
+    auth.login()
+    res = auth.client.post(prefix + f"/content/add_by/{pytest.prompt_id}?stream=true")
+    assert res.get_data(as_text=True).split("\n\n")[-2].startswith("event: error")
+    with app.app_context():  # content was written: failed stream used topic up
+        assert crud.peek_topics(1, pytest.prompt_id, 1)["topics"] == [topic_]
+        page = crud.get_content_all(1, {"prompt_id": pytest.prompt_id})["list"]
+        assert failed_topic in [i["title"] for i in page]
+
+    monkeypatch.setattr("gpt.creator.stream_openai_completion", fake_stream)
+    res = auth.client.post(prefix + f"/content/add_by/{pytest.prompt_id}?stream=true")
+    assert res.mimetype == "text/event-stream"
+    events = [i.split("\n") for i in res.get_data(as_text=True).split("\n\n") if i]
+    assert events[0][0] == "event: content"
+    assert events[1][0] == "event: text"
+    assert events[-1][0] == "event: done"
+    content_id = json.loads(events[0][1][6:])["content_id"]
+
+    data = json.loads(auth.client.get(prefix + f"/content/{content_id}").data)
+    assert data["title"] == topic_
+    assert data["text"].endswith("<h2>2. Second chapter</h2>\n\nchapter")
+    res = auth.client.get(prefix + f"/content/{content_id}/cfield")
+    assert json.loads(res.data)[0]["name"] == "field1"
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_continuation(monkeypatch: MonkeyPatch, app):
+    segments = [
+        ("The first part of a long text ends here", "length"),
+        ("of a long text ends here and the second part", "length"),
+        ("third part", "stop"),
+    ]
+    prompts = []
+
+    def fake_request(user_id, payload, cache):
+        prompts.append(payload["prompt"])
+        text, finish_reason = segments[len(prompts) - 1]
+        usage = {"prompt_tokens": 5, "completion_tokens": 10, "total_tokens": 15}
+        return {
+            "choices": [{"text": text, "finish_reason": finish_reason}],
+            "usage": usage,
+        }, False
+
+    monkeypatch.setattr("gpt.openai._request_completion", fake_request)
+    with app.app_context():
+        res = complete(1, "prompt", 1000)
+
+    assert res.text == (
+        "The first part of a long text ends here and the second part third part"
+    )
+    assert (res.segments, res.total_tokens, res.finish_reason) == (3, 45, "stop")
+    assert prompts[1].startswith(segments[0][0][-CONTINUE_OVERLAP:])
+    assert seam("abc", "xyz", 10) == 0
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_stream_continuation(monkeypatch: MonkeyPatch, app):
+    segments = [
+        ["The first part ", "of a long text ends here", ("", "length")],
+        ["of a long ", "text ends here", " and the second part", ("", "length")],
+        ["third part", ("", "stop")],
+    ]
+    prompts = []
+
+    def fake_choices(payload):
+        prompts.append(payload["prompt"])
+        for chunk in segments[len(prompts) - 1]:
+            text, finish_reason = chunk if isinstance(chunk, tuple) else (chunk, None)
+            yield {"text": text, "finish_reason": finish_reason}
+
+    monkeypatch.setattr("gpt.openai._stream_choices", fake_choices)
+    with app.app_context():
+        chunks = list(stream_openai_completion(1, "prompt", 1000))
+
+    assert "".join(chunks) == (
+        "The first part of a long text ends here and the second part third part"
+    )
+    assert len(prompts) == 3
+    assert prompts[1].startswith("The first part of a long text ends here...")
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_rate_limiter(tmp_path):
+    path = str(tmp_path / "ratelimit.db")
+    limiter = RateLimiter(path, {"m": (2, 100)}, (60, 1000))
+    assert limiter.reserve("m", 10) == 0
+    assert limiter.reserve("m", 10) == 0
+    assert 29 < limiter.reserve("m", 10) <= 30  # rpm=2: 1 request per 30 sec
+
+    other = RateLimiter(path, {"m": (60, 100)}, (60, 1000))  # other process
+    assert 11 < other.reserve("m", 100) <= 12  # tpm=100: 80 left, 20 in 12 sec
+    assert other.reserve("x", 1000) == 0
+
+    lock = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    lock.execute("BEGIN IMMEDIATE")  # other process holds the buckets
+    Thread(target=lambda: sleep(0.3) or lock.execute("COMMIT")).start()
+
+    async def loop_runs() -> int:
+        ticks = []
+
+        async def ticker():
+            while True:
+                ticks.append(1)
+                await asyncio.sleep(0.01)
+
+        task = asyncio.create_task(ticker())
+        await other.acquire_async("y", 1)
+        task.cancel()
+        return len(ticks)
+
+    assert asyncio.run(loop_runs()) > 5  # event loop not blocked by the lock
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_retry_policy():
+    request = httpx.Request("POST", "http://test/completions")
+
+    def error(status, headers=None, text=""):
+        response = httpx.Response(status, headers=headers, text=text, request=request)
+        return httpx.HTTPStatusError(str(status), request=request, response=response)
+
+    calls = []
+
+    def flaky(*errors):
+        async def func():
+            calls.append(1)
+            if len(calls) <= len(errors):
+                raise errors[len(calls) - 1]
+            return "ok"
+
+        return func
+
+    policy = RetryPolicy(attempts=3, base=0.01, cap=0.01)
+    assert policy.delay(0, error(429, {"Retry-After": "7"})) == 7
+    assert asyncio.run(policy.call_async(flaky(error(429), error(503)))) == "ok"
+    assert len(calls) == 3
+
+    calls.clear()
+    with pytest.raises(httpx.HTTPStatusError):  # fatal: no retry
+        asyncio.run(policy.call_async(flaky(error(400))))
+    assert len(calls) == 1
+
+    calls.clear()
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(policy.call_async(flaky(error(429, text="insufficient_quota"))))
+    assert len(calls) == 1
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_compact_toc(monkeypatch: MonkeyPatch, app):
+    toc = "\n".join(f"{i}. Chapter {i}\n- part {i}a\n- part {i}b" for i in range(1, 6))
+    written = []
+    monkeypatch.setattr(
+        Longread, "content_to_db", lambda self, **kw: written.append(kw)
+    )
+    with app.app_context():
+        pt = Prompt(user_id=1, params=json.dumps({"compact_toc": True}))
+        pt.toc = toc
+        constructor = LongreadTemplateConstructor(pt)
+        compact = constructor.make_longread_chapters()
+        full = constructor.make_longread_chapters(compact=False)
+        Longread(constructor).debug_longread()  # shows what longread() sends
+
+    assert compact[0] in written[0]["text"]
+
+    titles = pt.get_toc_list()
+    assert full == [constructor.make_longread_chapter(i) for i in titles]
+    assert "part 2a" in compact[0] and "part 3a" not in compact[0]
+    assert "1. Chapter 1\n2. Chapter 2" in compact[3]  # far chapters: titles
+    assert all(a < b for a, b in zip(count_tokens(compact), count_tokens(full)))
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_scheduler_tick(monkeypatch: MonkeyPatch, app):
+    from datetime import datetime
+
+    import gpt_scheduler
+
+    calls = []
+    events = [{"user_id": 1, "prompt_id": 2}, {"user_id": 1, "prompt_id": 2}]
+    monkeypatch.setattr(crud, "claim_due_timetables", lambda now, catchup: events)
+    ctx = SimpleNamespace(params=Params())
+    monkeypatch.setattr("gpt_scheduler.Context.load", lambda u, p: ctx)
+    monkeypatch.setattr(
+        "gpt_scheduler.gpt_run",
+        lambda *args, ctx: calls.append(args) or sleep(0.2),
+    )
+    dispatcher = Dispatcher(2, 2)
+    gpt_scheduler.tick(datetime(2024, 1, 1, 10, 30), dispatcher)
+    assert dispatcher.join(5)
+    assert calls == [(1, 2)]  # same prompt still queued -> skipped
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_dispatcher():
+    lock, running, peak = Lock(), Counter(), Counter()
+
+    def task(user_id):
+        with lock:
+            running[user_id] += 1
+            running["all"] += 1
+            peak[user_id] = max(peak[user_id], running[user_id])
+            peak["all"] = max(peak["all"], running["all"])
+        sleep(0.05)
+        with lock:
+            running[user_id] -= 1
+            running["all"] -= 1
+
+    dispatcher = Dispatcher(workers=3, per_user=2)
+    for i in range(6):
+        for user_id in (1, 2):
+            dispatcher.submit(user_id, (user_id, i), lambda u=user_id: task(u))
+    dispatcher.submit(3, (3, 0), lambda: None, deadline=time() - 1)
+    assert dispatcher.join(5)
+    dispatcher.shutdown()
+    assert peak[1] == peak[2] == 2 and peak["all"] == 3
+    res = dispatcher.summary()
+    assert res["done"] == 12 and res["expired"] == 1
+    assert res["wait"]["max"] > res["exec"]["p50"] > 0
+
+    hung, calls = Event(), []
+    dispatcher = Dispatcher(workers=2, per_user=1, timeout=0.2)
+    dispatcher.submit(1, (1, 0), hung.wait)
+    dispatcher.submit(1, (1, 1), lambda: calls.append(1))  # waits for user slot
+    assert dispatcher.join(5) and calls == [1]  # slot of hung task released
+    assert dispatcher.submit(1, (1, 0), lambda: None)  # its key too
+    assert dispatcher.join(5)
+    hung.set()
+    dispatcher.shutdown()
+    res = dispatcher.summary()
+    assert (res["timeout"], res["done"]) == (1, 2)
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_batch(monkeypatch: MonkeyPatch, auth):
+    running, peak = [0], [0]
+
+    async def fake_openai_async(user_id, prompt, tokens, **kwargs):
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+        await asyncio.sleep(0.01)
+        running[0] -= 1
+        if "text of" in prompt:  # fields
+            return "##kw " + prompt[prompt.index("text of") + 8 :][:5]
+        if "top_b" in prompt:
+            raise ValueError("openai error")
+        return "text of " + prompt[prompt.index("top_") :][:5]
+
+    monkeypatch.setattr("gpt.batch.create_openai_completion_async", fake_openai_async)
+    auth.login()
+    res = auth.client.post(
+        prefix + "/prompt/0",
+        data={
+            "template": f"about {TOPIC}",
+            "topic_list": "top_a; top_b; top_c; top_d; top_e",
+            "params": json.dumps({"debug": False, "pro": True, "batch": 3}),
+        },
+    )
+    prompt_id = json.loads(res.data)["prompt"]["id"]
+
+    res = auth.client.post(prefix + f"/content/batch_by/{prompt_id}", data={"n": 4})
+    res = json.loads(res.data)
+    assert res["failed"] == ["top_b"] and len(res["content_ids"]) == 3
+    assert 1 < peak[0] <= 4  # articles run concurrently
+    content_id = res["content_ids"][2]
+
+    res = auth.client.get(prefix + f"/prompt/{prompt_id}")
+    assert json.loads(res.data)["topic_list"] == "top_b; top_e"
+    res = auth.client.get(prefix + f"/content/{content_id}")
+    assert json.loads(res.data)["title"] == "top_d"
+    res = auth.client.get(prefix + f"/content/{content_id}/cfield")
+    assert json.loads(res.data)[0]["value"] == "top_d"
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_topic_used_by_written_content(monkeypatch: MonkeyPatch, app, auth):
+    def fake_openai(user_id, prompt, tokens, **kwargs):
+        if "text of" in prompt:  # fields
+            raise httpx.ConnectError("openai down")
+        return "text of " + prompt[prompt.index("top_") :][:5]
+
+    monkeypatch.setattr("gpt.creator.create_openai_completion", fake_openai)
+    auth.login()
+    res = auth.client.post(
+        prefix + "/prompt/0",
+        data={
+            "template": f"about {TOPIC}",
+            "topic_list": "top_1; top_2",
+            "params": json.dumps({"debug": False, "pro": True}),
+        },
+    )
+    prompt_id = json.loads(res.data)["prompt"]["id"]
+    with pytest.raises(Exception):
+        auth.client.post(prefix + f"/content/add_by/{prompt_id}")
+
+    with app.app_context():  # article is written: topic is not queued again
+        assert crud.peek_topics(1, prompt_id)["topics"] == ["top_2"]
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_resume(monkeypatch: MonkeyPatch, auth):
+    toc = "1. First chapter\n2. Second chapter\n3. Third chapter"
+    calls, down = [], [True]
+
+    async def fake_openai_async(user_id, prompt, tokens, **kwargs):
+        if mods.table_fields.format(toc) in prompt:
+            return "##field1 one"
+        calls.append(prompt)
+        if "2. Second chapter" in prompt.split(toc)[-1] and down[0]:
+            raise httpx.ConnectError("openai down")
+        return "chapter text"
+
+    monkeypatch.setattr("gpt.creator.create_openai_completion", lambda *a, **k: toc)
+    monkeypatch.setattr("gpt.creator.create_openai_completion_async", fake_openai_async)
+    auth.login()
+    res = auth.client.post(
+        prefix + "/prompt/0",
+        data={
+            "template": f"about {TOPIC}",
+            "topic_list": "resume topic",
+            "params": json.dumps({"debug": False, "longread": True}),
+        },
+    )
+    prompt_id = json.loads(res.data)["prompt"]["id"]
+    res = json.loads(auth.client.post(prefix + f"/content/add_by/{prompt_id}").data)
+    content_id, run_id = res["content_id"], res["run_id"]
+
+    run = json.loads(auth.client.get(prefix + f"/gen_run/{run_id}").data)
+    assert run["state"] == "partial" and run["content_id"] == content_id
+    assert [i["state"] for i in run["chapters"]] == ["done", "failed", "done"]
+
+    calls.clear()
+    down[0] = False
+    res = auth.client.post(prefix + f"/gen_run/{run_id}/resume")
+    assert json.loads(res.data)["resumed"] == [1]
+    assert len(calls) == 1  # only failed chapter, no TOC, no fields
+
+    run = json.loads(auth.client.get(prefix + f"/gen_run/{run_id}").data)
+    assert run["state"] == "done" and run["chapters"] == []  # text is in content
+    res = auth.client.post(prefix + f"/gen_run/{run_id}/resume")
+    assert json.loads(res.data)["resumed"] == [] and len(calls) == 1
+    text = json.loads(auth.client.get(prefix + f"/content/{content_id}").data)["text"]
+    assert "o_O" not in text and text.count("chapter text") == 3
+    assert text.index("1. First") < text.index("2. Second") < text.index("3. Third")
+
+
+@pytest.mark.skipif('config.getoption("--all") == "false"')
+def test_parse_mark():
+    text = "intro ##title: My title.\n##key-words a, b ###tag x##y"
+    expected = {"title": "My title", "key-words": "a, b #", "tag": "x", "y": ""}
+    assert parse_mark(text) == expected
+    for size in range(1, 8):  # marks split between stream chunks
+        parser = MarkParser()
+        closed = {}
+        for i in range(0, len(text), size):
+            closed |= parser.feed(text[i : i + size])
+        assert parser.close() == expected
+        assert closed == {"title": "My title", "key-words": "a, b #"}
@@ -46,11 +46,15 @@ def valid_psw(psw):
 
 
 def invalid_user(user_id) -> dict | None:
-    user = crud.get_user(user_id)
-    valid = (user, user.active, user.exp_date > time(), user.tokens > 0)
+    return check_user(crud.get_user(user_id).as_dict())
+
+
+def check_user(user: dict) -> dict | None:
+    "user row (dict) -> None if user can generate, else reasons"
+    valid = (user, user["active"], user["exp_date"] > time(), user["tokens"] > 0)
     if not all(valid):
         return {
-            "user_id": user.id,
+            "user_id": user["id"],
             "active": valid[1],
             "date": valid[2],
             "tokens": valid[3],
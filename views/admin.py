@@ -110,7 +110,7 @@ def pf_list_del():
     return redirect(url_for(".pf_list"))
 
 
-# GET prompt_id, limit + page
+# GET prompt_id, limit + after_id | before_id + count (legacy: page)
 @admin.route("/content/<user_id>")
 @login_req
 def content(user_id):
@@ -120,12 +120,12 @@ def content(user_id):
     )
 
 
-# GET limit + page
+# GET limit + after_id | before_id + count (legacy: page)
 @admin.route("/prompt/<int:user_id>")
 @login_req
 def prompt(user_id):
     prompt = crud.get_prompt_all(user_id, request.args)
-    pfield_dict = {i["id"]: crud.get_prompt_field_all(i["id"]) for i in prompt["list"]}
+    pfield_dict = crud.get_prompt_field_many([i["id"] for i in prompt["list"]])
     return render_template(
         "admin/a_prompt.html",
         prompt=prompt["list"],
@@ -5,7 +5,7 @@ from werkzeug.security import check_password_hash, generate_password_hash
 
 from crud import crud
 from dalle_gen import dalle_gen
-from gpt import gpt_gen
+from gpt.run import gpt_run
 from userlogin import UserLogin
 from utils import valid_psw
 
@@ -79,8 +79,9 @@ def logout():
 @login_required
 def prompt():
     prompt = crud.get_prompt_all(current_user.get_id(), request.args)
-    pfield_dict = {i["id"]: crud.get_prompt_field_all(i["id"]) for i in prompt["list"]}
-    timetable_dict = {i["id"]: crud.get_timetable_all(i["id"]) for i in prompt["list"]}
+    prompt_ids = [i["id"] for i in prompt["list"]]
+    pfield_dict = crud.get_prompt_field_many(prompt_ids)
+    timetable_dict = crud.get_timetable_many(prompt_ids)
     return render_template(
         "user/prompt.html",
         prompt=prompt["list"],
@@ -93,7 +94,10 @@ def prompt():
 @user.route("/prompt/<int:prompt_id>", methods=["GET", "POST"])
 def prompt_edit(prompt_id):
     if request.method == "POST":
-        crud.edit_prompt(current_user.get_id(), prompt_id, request.form)
+        res = crud.edit_prompt(current_user.get_id(), prompt_id, request.form)
+        if res.get("topics_skipped"):
+            skipped = "; ".join(res["topics_skipped"])
+            flash(f"topics with content are not queued again: {skipped}")
 
     prompt = crud.get_prompt(current_user.get_id(), prompt_id)
     pfield = crud.get_prompt_field_all(prompt_id)
@@ -173,9 +177,7 @@ def timetable_del():
 @login_required
 def content():
     content = crud.get_content_all(current_user.get_id(), request.args)
-    cfield_dict = {
-        i["id"]: crud.get_content_field_all(i["id"]) for i in content["list"]
-    }
+    cfield_dict = crud.get_content_field_many([i["id"] for i in content["list"]])
     return render_template(
         "user/content.html", content=content["list"], cfield_dict=cfield_dict
     )
@@ -203,7 +205,7 @@ def content_edit(content_id):
     )
 
 
-# POST None #[ ] gpt_gen
+# POST None #[ ] gpt_run
 @user.route("/content/get_topic/", methods=["POST"])
 @login_required
 def content_get_topic():
@@ -212,26 +214,26 @@ def content_get_topic():
         return render_template("user/topic_list.html", topic_list=[])
 
     try:
-        res = gpt_gen(current_user.get_id(), request.form.get("prompt_id"), topic=topic)
+        res = gpt_run(current_user.get_id(), request.form.get("prompt_id"), topic=topic)
         return render_template("user/topic_list.html", topic_list=res)
 
     except Exception as e:
         logger.exception(e)
-        flash(f"error gpt_gen.py: {e}")
+        flash(f"error gpt_run: {e}")
         return render_template("user/topic_list.html")
 
 
-# POST prompt_id #[ ] gpt_gen
+# POST prompt_id #[ ] gpt_run
 @user.route("/content/add", methods=["GET", "POST"])
 @login_required
 def content_add():
     if request.method == "POST":
         try:
-            gpt_gen(current_user.get_id(), request.form.get("prompt_id"))
+            gpt_run(current_user.get_id(), request.form.get("prompt_id"))
 
         except Exception as e:
             logger.exception(e)
-            flash(f"error gpt_gen.py: {e}")
+            flash(f"error gpt_run: {e}")
         return redirect(url_for(".content"))
 
     return render_template("user/item_add.html")